@@ -3,10 +3,14 @@ import feedparser
 
 import pandas as pd
 import tabulairity as tb
+import scrapertools as st
 
 import re
 
-from time import sleep
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
 
 
 #########################################
@@ -19,20 +23,69 @@ from time import sleep
 getGALink = lambda x: x.replace('https://www.google.com/url?rct=j&sa=t&url=','').split('&ct=ga')[0].split('%')[0]
 stripHTML = lambda x: re.sub(r'<.*?>', '', x)
 
-def feedToDf(feedURL):
-    """Takes a google alerts feed url and returns an article df"""
+feedWorkers = 16
+feedCols = ['title','published','updated','summary','url']
+
+
+def feedToDf(feedURL, conditional=True):
+    """Takes a google alerts feed url and returns an article df
+
+    With conditional, the feed's ETag/Last-Modified from the last poll are
+    sent back and an unchanged feed (304) returns its stored articles
+    without being downloaded or parsed again."""
     keepCols = ['link','title','published','updated','summary']
-    feed = feedparser.parse(feedURL)
+    validatorKey = f"feedValidators('{feedURL}')"
+    validatorHash = tb.getHash(validatorKey)
+    validators = tb.cacheGet(validatorHash) if conditional and tb.useCache else None
+
+    headers = {}
+    if validators is not None:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('lastModified'):
+            headers['If-Modified-Since'] = validators['lastModified']
+
+    response = st.getHttpSession().get(feedURL, headers=headers, timeout=30)
+    if response.status_code == 304 and validators is not None:
+        return pd.DataFrame(validators['entries'], columns=feedCols)
+    response.raise_for_status()
+
+    feed = feedparser.parse(response.content)
     entries = feed['entries']
     if entries == []:
-        return pd.DataFrame(keepCols)
-    feedDf = pd.DataFrame(entries)[keepCols]
-    feedDf.loc[:,'url'] = feedDf.link.apply(getGALink)
-    feedDf.summary = feedDf.summary.apply(stripHTML)
-    feedDf.title = feedDf.title.apply(stripHTML)
-    feedDf = feedDf.drop(['link'],axis=1)
+        feedDf = pd.DataFrame(columns=feedCols)
+    else:
+        feedDf = pd.DataFrame(entries).reindex(columns=keepCols)
+        feedDf.loc[:,'url'] = feedDf.link.apply(getGALink)
+        feedDf.summary = feedDf.summary.fillna('').apply(stripHTML)
+        feedDf.title = feedDf.title.fillna('').apply(stripHTML)
+        feedDf = feedDf.drop(['link'],axis=1)
+
+    if conditional and tb.useCache:
+        tb.cacheSet(validatorHash, validatorKey, {'etag': response.headers.get('ETag'),
+                                                  'lastModified': response.headers.get('Last-Modified'),
+                                                  'entries': feedDf.astype(object).where(feedDf.notnull(), None).to_dict('records')})
     return feedDf
 
+
+def fetchFeeds(feedURLs, numWorkers=None, conditional=True):
+    """Fetches many feeds concurrently, returning their article dfs in input order.
+
+    A feed that fails is reported and returns an empty df so one dead feed
+    does not stop the poll."""
+    if numWorkers is None:
+        numWorkers = feedWorkers
+
+    def fetch(feedURL):
+        try:
+            return feedToDf(feedURL, conditional)
+        except Exception as e:
+            print(f"[Feeds] Failed to fetch {feedURL}: {e}")
+            return pd.DataFrame(columns=feedCols)
+
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        return list(executor.map(fetch, feedURLs))
+
     
 def checkViability(pageText):
     """Checks if a scraped page is viable for analysis"""
@@ -45,26 +98,80 @@ def checkViability(pageText):
     return True
 
 
-def getGAlerts(alertsDf):
-    """Takes a google alerts feed google sheet and returns a full feeds df with translated titles"""
-    feedDfs = []
-    for index, row in alertsDf.iterrows():
-        feedURL = row['rss feed']
-        feedDf = feedToDf(feedURL)
+seenUrlKey = lambda url: f"seenArticle('{url}')"
+seenContentKey = lambda contentHash: f"seenContent('{contentHash}')"
+
+
+def filterSeen(values, keyFn):
+    """Returns a boolean list, True where a value is already in the seen-article index"""
+    hashes = [tb.getHash(keyFn(value)) for value in values]
+    seen = tb.cacheGetMany(hashes)
+    return [queryHash in seen for queryHash in hashes]
+
+
+def markArticlesSeen(articlesDf):
+    """Adds the urls and content hashes of an alerts df's viable pages to the seen-article index
+
+    Failed scrapes and non-viable pages are left out so the next poll retries them."""
+    seenAt = pd.Timestamp.now('UTC').isoformat()
+    viableDf = articlesDf[articlesDf['viable_page'].astype(bool)]
+    for url in viableDf['url']:
+        tb.cacheSet(tb.getHash(seenUrlKey(url)), seenUrlKey(url), seenAt)
+    if 'content_hash' in viableDf.columns:
+        for contentHash in viableDf['content_hash']:
+            tb.cacheSet(tb.getHash(seenContentKey(contentHash)), seenContentKey(contentHash), seenAt)
+
+
+def getGAlerts(alertsDf, nearDuplicates=None, incremental=False, markSeen=True):
+    """Takes a google alerts feed google sheet and returns a full feeds df with translated titles
+
+    nearDuplicates='flag' marks syndicated near-identical articles with
+    duplicate_of/is_representative columns, 'drop' keeps one per cluster.
+
+    With incremental, articles whose url or page content is already in the
+    seen-article index are dropped before translation and scraping, so only
+    the delta since the last run is returned. markSeen records the returned
+    articles, pass False and call markArticlesSeen once downstream processing
+    succeeds instead. The index lives in the cache database and ages out
+    with it."""
+    feedURLs = alertsDf['rss feed'].tolist()
+    feedDfs = fetchFeeds(feedURLs)
+    for feedURL, feedDf in zip(feedURLs, feedDfs):
         feedDf['rss feed'] = feedURL
-        feedDfs.append(feedDf)
 
     mergedFeeds = pd.concat(feedDfs)
     mergedFeeds = mergedFeeds.groupby('url').first().reset_index()
+    if incremental:
+        # An empty delta still runs through below so it carries the usual columns
+        unseen = pd.Series([not seen for seen in filterSeen(mergedFeeds['url'], seenUrlKey)],
+                           index=mergedFeeds.index, dtype=bool)
+        mergedFeeds = mergedFeeds[unseen]
     mergedFeeds = tb.autoTranslate(mergedFeeds,'title')
     mergedFeeds = tb.autoTranslate(mergedFeeds,'summary')
     mergedFeeds = mergedFeeds.merge(alertsDf)
-    mergedFeeds['scraped_text'] = mergedFeeds.url.apply(tb.cachePage)
+    mergedFeeds['scraped_text'] = tb.cachePages(mergedFeeds.url.tolist())
     mergedFeeds['viable_page'] = mergedFeeds.scraped_text.apply(checkViability)
     mergedFeeds['domain'] = mergedFeeds.url.str.split('/').str[2]
     mergedFeeds = mergedFeeds.groupby(['title','domain']).first().reset_index()
     mergedFeeds = mergedFeeds.groupby('url').first().reset_index()
 
+    if incremental:
+        mergedFeeds['content_hash'] = mergedFeeds.scraped_text.apply(tb.getHash)
+        seenContent = filterSeen(mergedFeeds['content_hash'], seenContentKey)
+        repeats = pd.Series([seen and viable for seen, viable in zip(seenContent, mergedFeeds['viable_page'])],
+                            index=mergedFeeds.index, dtype=bool)
+        if markSeen:
+            # Republished copies under new urls are recorded too so they are skipped next poll
+            markArticlesSeen(mergedFeeds[repeats])
+        mergedFeeds = mergedFeeds[~repeats].reset_index(drop=True)
+        if markSeen:
+            markArticlesSeen(mergedFeeds)
+
+    if nearDuplicates == 'flag':
+        mergedFeeds = tb.markNearDuplicates(mergedFeeds, 'scraped_text')
+    elif nearDuplicates == 'drop':
+        mergedFeeds = tb.dropNearDuplicates(mergedFeeds, 'scraped_text').reset_index(drop=True)
+
     return mergedFeeds
 
 
@@ -75,74 +182,262 @@ def getGAlerts(alertsDf):
 #########################################
 
 
+sheetWriteChunkRows = 5000
+sheetApiTimeout = 60
+_gClients = dict()
+_gSpreadsheets = dict()
+_gLock = threading.Lock()
+
+
+def getGClient(config: dict) -> gspread.Client:
+    """Returns a cached authenticated gspread client for the configured service account"""
+    path = config['g_service_json_path']
+    with _gLock:
+        if path not in _gClients:
+            client = gspread.service_account(filename=path)
+            # Bound slow calls so snapshot fallbacks can kick in
+            client.set_timeout(sheetApiTimeout)
+            _gClients[path] = client
+        return _gClients[path]
+
+
+def getGSpreadsheet(spreadsheetName: str,
+                    config: dict,
+                    refresh: bool = False) -> gspread.Spreadsheet:
+    """Returns a cached spreadsheet handle, opening it on first use or when refresh is set"""
+    key = (config['g_service_json_path'], spreadsheetName)
+    with _gLock:
+        spreadsheet = None if refresh else _gSpreadsheets.get(key)
+    if spreadsheet is None:
+        spreadsheet = getGClient(config).open(spreadsheetName)
+        with _gLock:
+            _gSpreadsheets[key] = spreadsheet
+    return spreadsheet
+
+
+def snapshotToDf(snapshot: dict) -> pd.DataFrame:
+    """Rebuilds a DataFrame from a stored worksheet snapshot"""
+    return pd.DataFrame(snapshot['records'], columns=snapshot['columns'])
+
+
 def gSheetToDf(spreadsheetName: str,
               worksheetName: str,
-              config: dict) -> pd.DataFrame:
+              config: dict,
+              ttl: float = None,
+              revisionCheck: bool = True) -> pd.DataFrame:
     """
     Pulls a table from a specified Google Sheet worksheet into a Pandas DataFrame.
 
+    With a ttl (seconds) the worksheet is snapshotted in the local cache and
+    reused while fresh. Once expired, the spreadsheet's Drive modifiedTime is
+    compared with the snapshot's before downloading the values again. If the
+    API call fails the last good snapshot is returned, whatever its age.
+
     Args:
         spreadsheetName: The name of the Google Sheet.
         worksheetName: The name of the specific worksheet (tab) within the sheet.
+        config: Dictionary containing path to service account credentials
+        ttl: Seconds a snapshot is served without contacting the API, None disables snapshots.
+        revisionCheck: Revalidate expired snapshots against the sheet's last update time.
 
     Returns:
         A Pandas DataFrame containing the data from the worksheet.
     """
+    snapshotKey = f"gSheetSnapshot('{spreadsheetName}','{worksheetName}')"
+    snapshotHash = tb.getHash(snapshotKey)
+    useSnapshot = ttl is not None and tb.useCache
+    snapshot = tb.cacheGet(snapshotHash) if useSnapshot else None
+    if snapshot is not None and time() - snapshot['fetched'] < ttl:
+        return snapshotToDf(snapshot)
+
     print(f"Attempting to read worksheet '{worksheetName}' from spreadsheet '{spreadsheetName}'...")
     try:
-        gc = gspread.service_account(filename=config['g_service_json_path'])
-        spreadsheet = gc.open(spreadsheetName)
+        spreadsheet = getGSpreadsheet(spreadsheetName, config)
+        revision = None
+        if useSnapshot and revisionCheck:
+            revision = spreadsheet.get_lastUpdateTime()
+            if snapshot is not None and snapshot.get('revision') == revision:
+                snapshot['fetched'] = time()
+                tb.cacheSet(snapshotHash, snapshotKey, snapshot)
+                print("Worksheet unchanged since last snapshot.")
+                return snapshotToDf(snapshot)
+
         worksheet = spreadsheet.worksheet(worksheetName)
         data = worksheet.get_all_records()
         df = pd.DataFrame(data)
-        
+
+        if useSnapshot:
+            tb.cacheSet(snapshotHash, snapshotKey, {'fetched': time(),
+                                                    'revision': revision,
+                                                    'columns': [str(col) for col in df.columns],
+                                                    'records': df.values.tolist()})
         print("Successfully loaded data into DataFrame.")
         return df 
     except gspread.exceptions.SpreadsheetNotFound:
         print(f"Error: Spreadsheet '{spreadsheetName}' not found.")
         print("Please check the spreadsheetName variable and ensure you have access.")
-        return pd.DataFrame()
     except gspread.exceptions.WorksheetNotFound:
         print(f"Error: Worksheet '{worksheetName}' not found in '{spreadsheetName}'.")
-        return pd.DataFrame()
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-        return pd.DataFrame()
+
+    if snapshot is not None:
+        print(f"Falling back to the last good snapshot of '{worksheetName}'.")
+        return snapshotToDf(snapshot)
+    return pd.DataFrame()
+
+
+def sheetCell(value):
+    """Converts a DataFrame value to what the Sheets API stores and returns for it"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+def dfToSheetValues(df: pd.DataFrame) -> list:
+    """Header plus rows of JSON safe cell values"""
+    rows = df.astype(object).values.tolist()
+    return [[str(col) for col in df.columns]] + [[sheetCell(value) for value in row] for row in rows]
+
+
+def rowRanges(rowNumbers: list) -> list:
+    """Groups sorted 1-based sheet row numbers into (first, last) runs of consecutive rows"""
+    runs = []
+    for rowNumber in rowNumbers:
+        if runs and rowNumber == runs[-1][1] + 1:
+            runs[-1][1] = rowNumber
+        else:
+            runs.append([rowNumber, rowNumber])
+    return runs
 
 
+def writeRows(worksheet, startRow: int, rows: list, chunkRows: int):
+    """Writes rows from startRow in chunked update calls"""
+    for start in range(0, len(rows), chunkRows):
+        worksheet.update(rows[start:start + chunkRows], f'A{startRow + start}')
+
 
 def dfToGSheet(df: pd.DataFrame,
                spreadsheetName: str,
                worksheetName: str,
-               config: dict):
+               config: dict,
+               mode: str = 'overwrite',
+               keyColumn: str = None,
+               chunkRows: int = None):
     """
     Pushes a Pandas DataFrame to a new or existing worksheet in a Google Sheet.
-    This will overwrite any existing data in the target worksheet.
+    By default this will overwrite any existing data in the target worksheet.
 
     Args:
         df: The Pandas DataFrame to write.
         spreadsheetName: The name of the Google Sheet.
         worksheetName: The name of the worksheet to create/overwrite.
-        config: Dictionary containing path to seri
+        config: Dictionary containing path to service account credentials
+        mode: 'overwrite' rewrites the sheet, 'append' adds only rows not already
+            present, 'diff' rewrites only rows that changed and appends new ones.
+            Both incremental modes fall back to overwrite if the headers differ.
+        keyColumn: Column identifying rows for 'append' and 'diff', whole rows
+            (append) or row positions (diff) are compared when None.
+        chunkRows: Rows per API request, defaults to sheetWriteChunkRows.
     """
+    if chunkRows is None:
+        chunkRows = sheetWriteChunkRows
     print(f"Attempting to write DataFrame to worksheet '{worksheetName}' in '{spreadsheetName}'...")
     try:
-        gc = gspread.service_account(filename=config['g_service_json_path'])
-        spreadsheet = gc.open(spreadsheetName)
+        spreadsheet = getGSpreadsheet(spreadsheetName, config)
+        values = dfToSheetValues(df)
+        numCols = len(values[0])
         try:
             worksheet = spreadsheet.worksheet(worksheetName)
-            print(f"Worksheet '{worksheetName}' already exists. Clearing it before writing new data.")
-            worksheet.clear()
+            existing = worksheet.get_all_values() if mode != 'overwrite' else []
         except gspread.exceptions.WorksheetNotFound:
             # If it doesn't exist, create it
             print(f"Worksheet '{worksheetName}' not found. Creating a new one.")
-            worksheet = spreadsheet.add_worksheet(title=worksheetName, rows="1000", cols="50")
-            
-        # Write the DataFrame to the worksheet
-        # gspread.utils.dataframe_to_rows returns an iterator, so we convert it to a list
-        rows_to_insert = [df.columns.values.tolist()] + df.values.tolist()
-        worksheet.update(rows_to_insert, 'A1')
-        
+            worksheet = spreadsheet.add_worksheet(title=worksheetName,
+                                                  rows=str(max(len(values), 1000)),
+                                                  cols=str(max(numCols, 50)))
+            existing = []
+
+        if mode != 'overwrite' and (not existing or existing[0][:numCols] != values[0]):
+            if existing:
+                print(f"Worksheet '{worksheetName}' headers differ, overwriting instead of {mode}.")
+            mode = 'overwrite'
+
+        if mode == 'overwrite':
+            print(f"Clearing worksheet '{worksheetName}' before writing new data.")
+            worksheet.clear()
+            worksheet.resize(rows=max(len(values), 1), cols=max(numCols, 1))
+            writeRows(worksheet, 1, values, chunkRows)
+
+        else:
+            asText = lambda row: tuple(str(cell) for cell in row[:numCols]) + ('',) * (numCols - len(row))
+            existingRows = [asText(row) for row in existing[1:]]
+            keyIdx = values[0].index(keyColumn) if keyColumn is not None else None
+
+            if mode == 'append':
+                if keyIdx is None:
+                    present = set(existingRows)
+                    newRows = [row for row in values[1:] if asText(row) not in present]
+                else:
+                    present = {row[keyIdx] for row in existingRows}
+                    newRows = [row for row in values[1:] if str(row[keyIdx]) not in present]
+                for start in range(0, len(newRows), chunkRows):
+                    worksheet.append_rows(newRows[start:start + chunkRows], value_input_option='RAW')
+                print(f"Appended {len(newRows)} new rows.")
+
+            elif mode == 'diff':
+                # Map each DataFrame row to the sheet row it should occupy
+                if keyIdx is None:
+                    targets = list(range(2, len(values) + 1))
+                else:
+                    rowOf = {row[keyIdx]: number + 2 for number, row in enumerate(existingRows)}
+                    nextRow = len(existingRows) + 2
+                    targets = []
+                    for row in values[1:]:
+                        key = str(row[keyIdx])
+                        if key not in rowOf:
+                            rowOf[key] = nextRow
+                            nextRow += 1
+                        targets.append(rowOf[key])
+
+                changed = {}
+                for target, row in zip(targets, values[1:]):
+                    current = existingRows[target - 2] if target - 2 < len(existingRows) else None
+                    if current != asText(row):
+                        changed[target] = row
+
+                lastRow = max(targets + [len(existingRows) + 1])
+                if lastRow > worksheet.row_count:
+                    worksheet.resize(rows=lastRow)
+
+                updates = [{'range': f'A{first}:{gspread.utils.rowcol_to_a1(last, numCols)}',
+                            'values': [changed[number] for number in range(first, last + 1)]}
+                           for first, last in rowRanges(sorted(changed))]
+                batch = []
+                batchRows = 0
+                for update in updates:
+                    batch.append(update)
+                    batchRows += len(update['values'])
+                    if batchRows >= chunkRows:
+                        worksheet.batch_update(batch)
+                        batch, batchRows = [], 0
+                if batch:
+                    worksheet.batch_update(batch)
+
+                if keyIdx is None and len(existingRows) > len(values) - 1:
+                    # Positional diff: clear rows the DataFrame no longer has
+                    worksheet.batch_clear([f'A{len(values) + 1}:{gspread.utils.rowcol_to_a1(len(existingRows) + 1, numCols)}'])
+                print(f"Updated {len(changed)} changed rows.")
+
+            else:
+                raise ValueError(f"Unknown write mode: {mode!r}")
+
         print("DataFrame successfully written to the worksheet.")
 
     except Exception as e:
@@ -1,36 +1,44 @@
 import re
 import pandas as pd
-from random import randint
+from random import randint, Random
+from statistics import NormalDist
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import tabulairity as tb
 import gsheetconnector as gs
 
 
 verbosity = 1
+evalWorkers = 4
+adaptiveBatchRows = 8
+adaptiveMinRows = 16
+adaptiveConfidence = 0.95
 
 
-def getSeedParams(randomize, model):
-    """Returns seed text and string depending on model"""
+def getSeedParams(randomize, model, seed=None):
+    """Returns seed text and string depending on model, using seed when given instead of a random one"""
     seedSupported = not model.startswith('gemini')
+    if seed is None:
+        seed = randint(0,9999)
     if not randomize:
         seed = None
         seedText = ''
-    if seedSupported:
-        seed = randint(0,9999)
+    elif seedSupported:
         seedText = ''
     else:
+        seedText = f'(random seed = {seed})'
         seed = None
-        seedText = f'(random seed = {randint(0,9999)})'
     return seed, seedText
 
 
 
-def getEvaluatorNet(supervisor='gemma3:27b'):
-    """Pulls and preps true/false evaluation net"""
+def getEvaluatorNet(supervisor='gemma3:27b', ttl=3600):
+    """Pulls and preps true/false evaluation net, reusing a local snapshot for up to ttl seconds"""
     evaluatorNetDf = gs.gSheetToDf('Google Alerts Trackers',
                                    'Answer Check Network',
-                                   tb.config)
+                                   tb.config,
+                                   ttl=ttl)
     evaluatorNetDf.loc[:,'model'] = supervisor
     evaluatorNet = tb.buildChatNet(evaluatorNetDf)
 
@@ -44,8 +52,11 @@ def rewritePrompt(prompt,
                   rewritePersona = False,
                   intentPrompt = None,
                   errorSummary = None,
-                  randomize = True):
-    """"Takes a given prompt and persona and returns an LLM improved version of each"""
+                  randomize = True,
+                  seed = None):
+    """"Takes a given prompt and persona and returns an LLM improved version of each
+
+    A given seed fixes the rewrite, retries step it by one per attempt."""
     maxTries = 20
     
     if intentPrompt is None:
@@ -57,14 +68,16 @@ def rewritePrompt(prompt,
     else:
         errorSummary = ' ' + errorSummary
 
-    seed, seedText = getSeedParams(randomize,model)
+    baseSeed = seed
     keptAllVars = False
     preservedIntent = False
     originalVars = tb.extractChatVars(prompt)
     tries = 0
     
     while not (keptAllVars and preservedIntent) and tries != maxTries:
-        seed, seedText = getSeedParams(randomize,model)
+        seed, seedText = getSeedParams(randomize,
+                                       model,
+                                       None if baseSeed is None else baseSeed + tries)
         questionPrompt = f"""Rewrite the following prompt text to maximize its performance according to the criteria below.{intentPrompt}{errorSummary}
 
 Objectives:
@@ -163,16 +176,23 @@ def evaluateAnswer(originalPrompt,
                    persona,
                    varsIn,
                    model,
-                   evaluatorNet):
-    """Evaluates the y/n correctness of an answer, returning an explanation of the error if found"""
+                   evaluatorNet,
+                   bypassCache = False):
+    """Evaluates the y/n correctness of an answer, returning an explanation of the error if found
+
+    duration is the answer's model latency, taken from the cached call
+    metadata on cache hits (wall time if none was stored), and tokens its
+    prompt plus completion tokens. bypassCache re-runs the answer call."""
     
+    tStart = datetime.now()
+    calls = []
     try:
-        tStart = datetime.now()
         preppedPrompt = tb.insertChatVars(originalPrompt,varsIn)
-        answer = tb.askChatQuestion(preppedPrompt,
-                                    persona,
-                                    model,
-                                    tokens = 4000)
+        with tb.recordCalls(bypassCache = bypassCache) as calls:
+            answer = tb.askChatQuestion(preppedPrompt,
+                                        persona,
+                                        model,
+                                        tokens = 4000)
         tFinish = datetime.now()
         duration = (tFinish - tStart).total_seconds()
         
@@ -192,8 +212,100 @@ def evaluateAnswer(originalPrompt,
         print("Error:",e)
         answeredCorrectly = False
         explanation = None
+        duration = (datetime.now() - tStart).total_seconds()
+
+    usage = tb.summarizeCalls(calls)
+    if any(call.get('latency') is not None for call in calls):
+        duration = usage['latency']
+    tokens = usage['prompt_tokens'] + usage['completion_tokens']
         
-    return answeredCorrectly, explanation, duration
+    return answeredCorrectly, explanation, duration, tokens
+
+
+def promptObjective(score, time, tokens, latencyWeight = 0.0, tokenWeight = 0.0):
+    """Accuracy penalized by mean seconds and tokens per answer"""
+    return score - latencyWeight * time - tokenWeight * tokens
+
+
+def resolveAdaptive(adaptive, latencyWeight = 0.0, tokenWeight = 0.0):
+    """Returns whether adaptive stopping can be used with the given objective weights"""
+    if adaptive and (latencyWeight != 0 or tokenWeight != 0):
+        # The confidence bound covers accuracy only, it cannot rule out a faster or cheaper winner
+        print("Adaptive stopping is disabled while latency or token weights are set.")
+        return False
+    return adaptive
+
+
+def wilsonInterval(successes, trials, confidence = None):
+    """Wilson score interval for a success rate"""
+    if confidence is None:
+        confidence = adaptiveConfidence
+    if trials == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    rate = successes / trials
+    denominator = 1 + z**2 / trials
+    center = (rate + z**2 / (2 * trials)) / denominator
+    margin = z * ((rate * (1 - rate) + z**2 / (4 * trials)) / trials) ** 0.5 / denominator
+    return max(center - margin, 0.0), min(center + margin, 1.0)
+
+
+def evaluateTestSet(prompt,
+                    persona,
+                    testDf,
+                    model,
+                    evaluatorNet,
+                    numWorkers = None,
+                    incumbent = None,
+                    seed = None,
+                    bypassCache = False,
+                    stopWhen = None):
+    """Evaluates a prompt on the test rows concurrently, returning scores, errors, times and tokens
+
+    Without an incumbent every row is evaluated and results come back in
+    row order. Given an incumbent score, rows are evaluated in a seeded
+    random order in batches of adaptiveBatchRows, stopping once at least
+    adaptiveMinRows are scored and the Wilson interval on the success rate
+    lies entirely below the incumbent (it cannot beat it). Only the
+    evaluated rows are returned in that case. Candidates that look better
+    are always scored on every row so their score is never a partial one.
+    Rows not yet started once stopWhen() returns True are skipped."""
+    if numWorkers is None:
+        numWorkers = evalWorkers
+    rows = [row for _, row in testDf.iterrows()]
+    def evaluateRow(row):
+        if stopWhen is not None and stopWhen():
+            return None
+        return evaluateAnswer(prompt,
+                              persona,
+                              row,
+                              model,
+                              evaluatorNet,
+                              bypassCache)
+    evaluate = tb.carryCallRecorders(evaluateRow)
+
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        if incumbent is None:
+            results = [result for result in executor.map(evaluate, rows) if result is not None]
+        else:
+            Random(seed).shuffle(rows)
+            results = []
+            for start in range(0, len(rows), adaptiveBatchRows):
+                batch = list(executor.map(evaluate, rows[start:start + adaptiveBatchRows]))
+                results += [result for result in batch if result is not None]
+                if None in batch:
+                    break
+                if len(results) < adaptiveMinRows or len(results) == len(rows):
+                    continue
+                _, upper = wilsonInterval(sum(bool(result) for result, _, _, _ in results), len(results))
+                if upper < incumbent:
+                    break
+
+    scores = [result for result, _, _, _ in results]
+    errors = [error for _, error, _, _ in results if error is not None]
+    times = [duration for _, _, duration, _ in results]
+    tokens = [tokenCount for _, _, _, tokenCount in results]
+    return scores, errors, times, tokens
 
 
 def extractIntent(prompt,
@@ -274,16 +386,46 @@ Prompt: [prompt]
 
 
 
+def prepTestSet(prompt, testDfIn):
+    """Copies the test set, warning about prompt vars it does not provide"""
+    testDf = testDfIn.copy(deep=True)
+    varsInData = set(testDf.columns)
+    varsInPrompt = set(tb.extractChatVars(prompt))
+    missingVars = varsInPrompt.difference(varsInData)
+    if len(missingVars) != 0:
+        print(f"Warning: some expected prompt vars were not found in the passed DataFrame, is this intentional?\n\t{missingVars}")
+    return testDf
+
+
+
 def iteratePrompt(bestPrompt,
                   bestPersona,
                   testDfIn,
                   model,
                   depth=20,
                   intent=None,
-                  supervisor=None):
-    """Processes a tabulairity extraction for a single prompt and iteratively improves it"""
+                  supervisor=None,
+                  numWorkers=None,
+                  adaptive=False,
+                  seed=None,
+                  latencyWeight=0.0,
+                  tokenWeight=0.0,
+                  bypassCache=False):
+    """Processes a tabulairity extraction for a single prompt and iteratively improves it
+
+    Test rows are evaluated concurrently across numWorkers threads (evalWorkers by default).
+    With adaptive, candidates are scored on a seeded random row order and
+    dropped as soon as a confidence bound shows they cannot beat the best
+    score, see evaluateTestSet. history records rows_evaluated for the best
+    prompt and candidate_rows for the rows the iteration's candidate used.
+
+    Candidates are kept when they improve the objective, accuracy minus
+    latencyWeight per mean answer second and tokenWeight per mean answer
+    token. Latency is real model latency, bypassCache re-runs cached answers.
+    adaptive is ignored when either weight is set, as its bound covers accuracy only."""
     if supervisor is None:
         supervisor = model
+    adaptive = resolveAdaptive(adaptive, latencyWeight, tokenWeight)
 
     evaluatorNet = getEvaluatorNet(supervisor)
 
@@ -291,48 +433,46 @@ def iteratePrompt(bestPrompt,
         intent = extractIntent(bestPrompt, supervisor)
         print("Inferred intent:",intent)
 
-    testDf = testDfIn.copy(deep=True)
-    varsInData = set(testDf.columns)
-    varsInPrompt = set(tb.extractChatVars(bestPrompt))
-    missingVars = varsInPrompt.difference(varsInData)
-    #print("DEBOOO1",varsInPrompt)
-    #print("DEBOOO2",varsInData)
-    if len(missingVars) != 0:
-        print(f"Warning: some expected prompt vars were not found in the passed DataFrame, is this intentional?\n\t{missingVars}")
+    testDf = prepTestSet(bestPrompt, testDfIn)
 
-    # Evaluate initial prompt
-    bestErrors = []
-    bestScores = []
-    bestTimes = []
-    for _, row in testDf.iterrows():
-        result, error, duration = evaluateAnswer(bestPrompt,
-                                                 bestPersona,
-                                                 row,
-                                                 model,
-                                                 evaluatorNet)
-        bestScores.append(result)
-        bestTimes.append(duration)
-        if error is not None:
-            bestErrors.append(error)
+    if seed is None:
+        seed = randint(0,9999)
 
+    # Evaluate initial prompt
+    bestScores, bestErrors, bestTimes, bestTokens = evaluateTestSet(bestPrompt,
+                                                                    bestPersona,
+                                                                    testDf,
+                                                                    model,
+                                                                    evaluatorNet,
+                                                                    numWorkers,
+                                                                    bypassCache = bypassCache)
+
+    weighted = latencyWeight != 0 or tokenWeight != 0
     bestScore = float(sum(bestScores) / len(bestScores))
     bestTime = float(sum(bestTimes) / len(bestTimes))
+    bestTokens = float(sum(bestTokens) / len(bestTokens))
+    bestObjective = promptObjective(bestScore, bestTime, bestTokens, latencyWeight, tokenWeight)
     initialScore = bestScore
+    bestRows = len(bestScores)
     history = [{'prompt':bestPrompt,
                 'intent':intent,
                 'persona':bestPersona,
                 'score':bestScore,
                 'time':bestTime,
+                'tokens':bestTokens,
+                'objective':bestObjective,
+                'rows_evaluated':bestRows,
+                'candidate_rows':bestRows,
                 'iteration':0}]
 
-    if bestScore == 1:
+    if bestScore == 1 and not weighted:
         print("All responses flagged as correct, returning finalized prompt and persona.")
         return pd.DataFrame(history)
 
     if bestErrors == []:
         errorReport = "No errors were logged."
     else:
-        errorReport = '\n'.join([f'* {e}' for e in set(bestErrors)])
+        errorReport = '\n'.join([f'* {e}' for e in dict.fromkeys(bestErrors)])
 
     # Begin iterative improvements
     for i in range(depth):
@@ -343,44 +483,51 @@ def iteratePrompt(bestPrompt,
                                               intentPrompt = intent,
                                               errorSummary = errorReport)
 
-        newErrors = []
-        newScores = []
-        newTimes = []
-        for _, row in testDf.iterrows():
-            result, error, duration = evaluateAnswer(newPrompt,
-                                                     newPersona,
-                                                     row,
-                                                     model,
-                                                     evaluatorNet)
-            newScores.append(result)
-            newTimes.append(duration)
-            if error is not None:
-                newErrors.append(error)
+        newScores, newErrors, newTimes, newTokens = evaluateTestSet(newPrompt,
+                                                                    newPersona,
+                                                                    testDf,
+                                                                    model,
+                                                                    evaluatorNet,
+                                                                    numWorkers,
+                                                                    incumbent = bestScore if adaptive else None,
+                                                                    seed = seed,
+                                                                    bypassCache = bypassCache)
 
         newScore = float(sum(newScores) / len(newScores))
         newTime = float(sum(newTimes) / len(newTimes))
-        print(f"Model: {model}     Best score: {bestScore}    New score: {newScore}")
+        newTokens = float(sum(newTokens) / len(newTokens))
+        newObjective = promptObjective(newScore, newTime, newTokens, latencyWeight, tokenWeight)
+        print(f"Model: {model}     Best score: {bestScore}    New score: {newScore}    Rows: {len(newScores)}/{len(testDf)}")
+        if weighted:
+            print(f"Best objective: {bestObjective}    New objective: {newObjective}    Time: {newTime}    Tokens: {newTokens}")
 
-        if newScore > bestScore:
+        if newObjective > bestObjective and len(newScores) == len(testDf):
             bestScore = newScore
             bestPrompt = newPrompt
             bestPersona = newPersona
             bestErrors = newErrors
             bestTime = newTime
+            bestTokens = newTokens
+            bestObjective = newObjective
+            bestRows = len(newScores)
             
         history.append({'prompt':bestPrompt,
                         'intent':intent,
                         'persona':bestPersona,
                         'score':bestScore,
                         'time':bestTime,
+                        'tokens':bestTokens,
+                        'objective':bestObjective,
+                        'rows_evaluated':bestRows,
+                        'candidate_rows':len(newScores),
                         'iteration':i})
 
-        if bestScore == 1:
+        if bestScore == 1 and not weighted:
             print("All responses flagged as correct, returning finalized prompt and persona.")
             return pd.DataFrame(history)
 
 
-        errorList = '\n'.join([f'* {iError}' for iError in set(bestErrors)])
+        errorList = '\n'.join([f'* {iError}' for iError in dict.fromkeys(bestErrors)])
         errorReport = summarizeErrors(errorList,
                                       intent,
                                       supervisor)
@@ -390,3 +537,179 @@ def iteratePrompt(bestPrompt,
 
     print(f"Iterations complete, initial score: {initialScore}   final score: {bestScore}")
     return pd.DataFrame(history)
+
+
+
+def beamSearchPrompt(bestPrompt,
+                     bestPersona,
+                     testDfIn,
+                     model,
+                     rounds=5,
+                     beamWidth=3,
+                     branching=3,
+                     budget=None,
+                     intent=None,
+                     supervisor=None,
+                     numWorkers=None,
+                     adaptive=False,
+                     seed=None,
+                     latencyWeight=0.0,
+                     tokenWeight=0.0,
+                     bypassCache=False):
+    """Improves a prompt with a beam search over rewrites instead of a single hill-climb
+
+    Each round every prompt in the beam is rewritten branching times with
+    distinct seeds, the rewrites are evaluated in parallel and the top
+    beamWidth prompts seen so far form the next beam. Only fully scored
+    candidates can join the beam. budget is a soft cap on the uncached LLM
+    calls made by this search, rewrites and test rows are not started once
+    it is reached but calls already in flight complete. With adaptive,
+    candidates that cannot beat the weakest beam member stop early. Candidates
+    are ranked on the same objective as iteratePrompt, and as there adaptive
+    is ignored when latency or token weights are set.
+
+    Returns one history row per evaluated candidate, with candidate_id,
+    parent_id and the round it was generated in as iteration."""
+    with tb.recordCalls() as searchCalls:
+        # Soft budget over this search's own uncached calls, worker threads report here too
+        overBudget = lambda: budget is not None and sum(not call.get('cached') for call in searchCalls) >= budget
+
+        if supervisor is None:
+            supervisor = model
+        adaptive = resolveAdaptive(adaptive, latencyWeight, tokenWeight)
+        rng = Random(seed)
+
+        evaluatorNet = getEvaluatorNet(supervisor)
+
+        if intent is None:
+            intent = extractIntent(bestPrompt, supervisor)
+            print("Inferred intent:",intent)
+
+        testDf = prepTestSet(bestPrompt, testDfIn)
+        rowSeed = rng.randint(0,9999)
+
+        def evaluateCandidate(candidate, incumbent=None, stopWhen=None):
+            scores, errors, times, tokens = evaluateTestSet(candidate['prompt'],
+                                                            candidate['persona'],
+                                                            testDf,
+                                                            model,
+                                                            evaluatorNet,
+                                                            numWorkers,
+                                                            incumbent = incumbent,
+                                                            seed = rowSeed,
+                                                            bypassCache = bypassCache,
+                                                            stopWhen = stopWhen)
+            if scores == []:
+                return None
+            candidate['score'] = float(sum(scores) / len(scores))
+            candidate['time'] = float(sum(times) / len(times))
+            candidate['tokens'] = float(sum(tokens) / len(tokens))
+            candidate['objective'] = promptObjective(candidate['score'],
+                                                     candidate['time'],
+                                                     candidate['tokens'],
+                                                     latencyWeight,
+                                                     tokenWeight)
+            candidate['rows_evaluated'] = len(scores)
+            candidate['errors'] = errors
+            return candidate
+
+        root = evaluateCandidate({'prompt':bestPrompt,
+                                  'persona':bestPersona,
+                                  'candidate_id':0,
+                                  'parent_id':None,
+                                  'iteration':0})
+        candidates = [root]
+        beam = [root]
+        seenPrompts = {bestPrompt}
+
+        for roundNum in range(1, rounds + 1):
+            if beam[0]['score'] == 1 and latencyWeight == 0 and tokenWeight == 0:
+                print("All responses flagged as correct, returning finalized prompt and persona.")
+                break
+            if overBudget():
+                print(f"LLM request budget of {budget} reached before round {roundNum}.")
+                break
+
+            def reportErrors(candidate):
+                errorList = '\n'.join([f'* {iError}' for iError in dict.fromkeys(candidate['errors'])])
+                if errorList == '':
+                    candidate['errorReport'] = "No errors were logged."
+                else:
+                    errorReport = summarizeErrors(errorList,
+                                                  intent,
+                                                  supervisor)
+                    candidate['errorReport'] = f'The current prompt yields {round(candidate["score"],2)*100}% accuracy. {errorReport}'
+
+            def expand(task):
+                parent, candidateSeed = task
+                if overBudget():
+                    return None
+                try:
+                    newPrompt, newPersona = rewritePrompt(parent['prompt'],
+                                                          parent['persona'],
+                                                          supervisor,
+                                                          intentPrompt = intent,
+                                                          errorSummary = parent['errorReport'],
+                                                          seed = candidateSeed)
+                except ValueError as e:
+                    print("Error:",e)
+                    return None
+                return {'prompt':newPrompt,
+                        'persona':newPersona,
+                        'parent_id':parent['candidate_id'],
+                        'iteration':roundNum}
+
+            unreported = [candidate for candidate in beam if 'errorReport' not in candidate]
+            if unreported:
+                with ThreadPoolExecutor(max_workers=len(unreported)) as executor:
+                    list(executor.map(tb.carryCallRecorders(reportErrors), unreported))
+
+            # Distinct seeds so sibling rewrites do not collapse onto one cached answer
+            seeds = rng.sample(range(10000), len(beam) * branching)
+            tasks = [(parent, seeds[i * branching + j]) for i, parent in enumerate(beam) for j in range(branching)]
+            with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+                rewrites = list(executor.map(tb.carryCallRecorders(expand), tasks))
+
+            newCandidates = []
+            for rewrite in rewrites:
+                if rewrite is None or rewrite['prompt'] in seenPrompts:
+                    continue
+                seenPrompts.add(rewrite['prompt'])
+                rewrite['candidate_id'] = len(candidates) + len(newCandidates)
+                newCandidates.append(rewrite)
+
+            if newCandidates == []:
+                print(f"No new candidates generated in round {roundNum}.")
+                continue
+            if overBudget():
+                print(f"LLM request budget of {budget} reached during round {roundNum}.")
+                break
+
+            incumbent = beam[-1]['score'] if adaptive and len(beam) == beamWidth else None
+            evaluate = lambda candidate: evaluateCandidate(candidate, incumbent, stopWhen=overBudget)
+            with ThreadPoolExecutor(max_workers=len(newCandidates)) as executor:
+                newCandidates = [candidate for candidate in executor.map(tb.carryCallRecorders(evaluate), newCandidates)
+                                 if candidate is not None]
+            candidates += newCandidates
+
+            # Early stopped (rejected or out of budget) candidates hold partial scores and stay out of the beam
+            fullyScored = [candidate for candidate in newCandidates if candidate['rows_evaluated'] == len(testDf)]
+            beam = sorted(beam + fullyScored, key=lambda candidate: -candidate['objective'])[:beamWidth]
+            print(f"Model: {model}    Round: {roundNum}    Beam scores: {[round(c['score'],3) for c in beam]}")
+
+        print(f"Beam search complete, initial score: {root['score']}   final score: {beam[0]['score']}")
+        history = [{'prompt':candidate['prompt'],
+                    'intent':intent,
+                    'persona':candidate['persona'],
+                    'score':candidate['score'],
+                    'time':candidate['time'],
+                    'tokens':candidate['tokens'],
+                    'objective':candidate['objective'],
+                    'rows_evaluated':candidate['rows_evaluated'],
+                    'iteration':candidate['iteration'],
+                    'candidate_id':candidate['candidate_id'],
+                    'parent_id':candidate['parent_id']}
+                   for candidate in candidates]
+        historyDf = pd.DataFrame(history)
+        historyDf['parent_id'] = historyDf['parent_id'].astype('Int64')
+        return historyDf
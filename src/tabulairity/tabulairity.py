@@ -5,12 +5,19 @@ import numpy as np
 import scrapertools as st
 
 from datetime import datetime
+from contextlib import contextmanager, nullcontext
+from collections import Counter, OrderedDict
 from copy import deepcopy
+from itertools import zip_longest
+from urllib.parse import urlparse
 from matplotlib import pyplot as plt
-from time import sleep
+from time import sleep, monotonic, time
 from bs4 import BeautifulSoup
-from litellm import completion
-from langdetect import detect
+from litellm import completion, token_counter
+from litellm.llms.custom_httpx.http_handler import HTTPHandler
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from langdetect import detect_langs, DetectorFactory
+from langdetect.lang_detect_exception import LangDetectException
 from random import uniform, randint
 
 import os
@@ -23,8 +30,13 @@ import hashlib
 import pycountry
 import sqlite3
 import asyncio
+import httpx
+import litellm
+import threading
 import traceback
 import sys
+import zlib
+import uuid
 
 #########################################
 #                                       #
@@ -162,6 +174,35 @@ def cacheGet(queryHash):
             returnConnection(conn)
 
 
+def cacheGetMany(queryHashes, batchSize=500):
+    """Retrieve many cached results in batched queries, returns {hash: result} for the hits"""
+    queryHashes = list(dict.fromkeys(queryHashes))
+    found = dict()
+    conn = None
+    try:
+        conn = getConnection()
+        cursor = conn.cursor()
+        marker = '%s' if cacheConfig['backend'] == 'postgres' else '?'
+
+        for start in range(0, len(queryHashes), batchSize):
+            batch = queryHashes[start:start + batchSize]
+            cursor.execute(
+                f"SELECT hash, response FROM cache WHERE hash IN ({','.join([marker] * len(batch))})",
+                tuple(batch)
+            )
+            for queryHash, response in cursor.fetchall():
+                found[queryHash] = json.loads(response)
+
+        cursor.close()
+        return found
+
+    except Exception as e:
+        return found
+    finally:
+        if conn:
+            returnConnection(conn)
+
+
 def cacheSet(queryHash, query, result):
     """Store query result in cache"""
     conn = None
@@ -356,6 +397,11 @@ maxTranslateTokens = 8000
 promptDelay = 0.0
 targetLanguage = 'en'
 translationModel = "gemma3:27b"
+translateWorkers = 4
+translateBatchTokens = 1500
+translateBatchItems = 50
+translateItemTokens = 200
+translateChunkTokens = 2000
 
 
 def prepEnvironment(routesRef='config/model_routes.csv'):
@@ -383,7 +429,6 @@ def prepEnvironment(routesRef='config/model_routes.csv'):
     if os.path.exists(routesRef):
         routes = pd.read_csv(routesRef)
         routes = routes.replace({np.nan: None, 'remote': None})
-        routes['last used'] = datetime.utcnow()
     else:
         routes = {modelName: {'route': modelName,
                               'ip': 'http://localhost:11434'}}
@@ -392,47 +437,448 @@ def prepEnvironment(routesRef='config/model_routes.csv'):
     return routes
 
 
-modelRoutes = prepEnvironment()
+#########################################
+#                                       #
+#      LOAD-AWARE ROUTING               #
+#                                       #
+#########################################
 
+routeLatencyAlpha = 0.2
+routeAdmissionPoll = 1.0
+circuitFailureThreshold = 3
+circuitCooldown = 60.0
+circuitTrialWait = 120.0
+routeTable = dict()
+_routeLock = threading.Condition()
+_routeTableStart = monotonic()
 
-def getModelRoute(name):
-    """Model route accessor with LRU"""
+
+def newTokenBucket(perMinute):
+    """Returns a token bucket refilled at perMinute/60 per second, or None if unlimited"""
+    if perMinute is None:
+        return None
+    return {'capacity': float(perMinute),
+            'level': float(perMinute),
+            'rate': float(perMinute) / 60,
+            'updated': monotonic()}
+
+
+def refillBucket(bucket, now):
+    """Tops up a token bucket for the time elapsed since its last update"""
+    if bucket is not None:
+        bucket['level'] = min(bucket['capacity'],
+                              bucket['level'] + (now - bucket['updated']) * bucket['rate'])
+        bucket['updated'] = now
+
+
+def bucketWait(bucket, amount):
+    """Seconds until a bucket can cover amount, capped at its capacity"""
+    if bucket is None:
+        return 0.0
+    shortfall = min(amount, bucket['capacity']) - bucket['level']
+    return max(shortfall, 0.0) / bucket['rate']
+
+
+def newRouteState(model, route, ip, maxConcurrency=None, rpm=None, tpm=None):
+    """Returns a fresh in-memory state record for one model endpoint"""
+    missing = lambda x: x is None or x != x or x == ''
+    limit = lambda x: None if missing(x) or float(x) <= 0 else float(x)
+    return {'model': model,
+            'route': model if missing(route) else route,
+            'ip': None if missing(ip) else ip,
+            'maxConcurrency': limit(maxConcurrency),
+            'requestBucket': newTokenBucket(limit(rpm)),
+            'tokenBucket': newTokenBucket(limit(tpm)),
+            'outstanding': 0,
+            'requests': 0,
+            'failures': 0,
+            'latency': None,
+            'busySeconds': 0.0,
+            'waitSeconds': 0.0,
+            'lastUsed': 0.0,
+            'circuit': 'closed',
+            'consecutiveFailures': 0,
+            'openedAt': None,
+            'healthy': None,
+            'lastProbe': None,
+            'lastError': None}
+
+
+def buildRouteTable(routes):
+    """Indexes a model routes DataFrame into a {model: [route state]} table"""
+    global routeTable, _routeTableStart
+
+    if 'model' in routes.columns:
+        models = routes['model'].tolist()
+    else:
+        models = routes.index.tolist()
+
+    table = dict()
+    for model, (_, row) in zip(models, routes.iterrows()):
+        table.setdefault(model, []).append(newRouteState(model,
+                                                         row.get('route'),
+                                                         row.get('ip'),
+                                                         row.get('max_concurrency'),
+                                                         row.get('rpm'),
+                                                         row.get('tpm')))
+
+    with _routeLock:
+        routeTable = table
+        _routeTableStart = monotonic()
+        _routeLock.notify_all()
+    return table
+
+
+def setModelRoutes(routes):
+    """Replaces the active model routes and rebuilds the routing table"""
     global modelRoutes
+    modelRoutes = routes
+    buildRouteTable(routes)
+
 
-    for col in ['model', 'route', 'ip', 'last used']:
-        if col not in modelRoutes.columns:
-            modelRoutes[col] = None
+def routeScore(state):
+    """Expected wait for a new request on a route, lower is better.
 
-    matches = modelRoutes.loc[modelRoutes['model'] == name]
+    Routes with no latency history score zero so they get explored first,
+    ties fall back to fewest outstanding requests then least recently used."""
+    latency = state['latency'] or 0.0
+    return ((state['outstanding'] + 1) * latency,
+            state['outstanding'],
+            state['lastUsed'])
 
-    if matches.empty:
+
+def getRouteCandidates(name):
+    """Returns the route states for a model, registering unknown models. Caller holds _routeLock"""
+    candidates = routeTable.get(name)
+    if not candidates:
         print(f"[Config] {name} not found in routes, adding...")
         if 'ollama/' in name:
             defaultIP = 'http://localhost:11434'
         else:
             defaultIP = None
+        candidates = [newRouteState(name, name, defaultIP)]
+        routeTable[name] = candidates
+    return candidates
+
 
-        modelRoutes.loc[len(modelRoutes)] = {'model': name,
-                                              'route': name,
-                                              'ip': defaultIP,
-                                              'last used': datetime.utcnow()}
-        return name, defaultIP
-
-    if len(matches) > 1:
-        temp = matches.copy()
-        temp['last used'] = pd.to_datetime(temp['last used'], errors='coerce')
-        if temp['last used'].notnull().any():
-            chosenIdx = temp['last used'].idxmin()
+def circuitAllows(state, now):
+    """True if a route's circuit breaker lets a request through.
+
+    Open circuits admit a single half-open trial request once the cooldown
+    has elapsed, its outcome decides whether the circuit closes again."""
+    if state['circuit'] == 'closed':
+        return True
+    if state['circuit'] == 'open':
+        return now - state['openedAt'] >= circuitCooldown
+    return False
+
+
+def tripCircuit(state, now, error):
+    """Records a route fault, opening the circuit after too many consecutive faults. Caller holds _routeLock"""
+    state['consecutiveFailures'] += 1
+    state['lastError'] = str(error)[:200]
+    if state['circuit'] == 'half-open' or state['consecutiveFailures'] >= circuitFailureThreshold:
+        if state['circuit'] != 'open':
+            print(f"[Route] Circuit opened for {state['route']} @ {state['ip']}: {state['lastError']}")
+        state['circuit'] = 'open'
+        state['openedAt'] = now
+
+
+def resetCircuit(state):
+    """Closes a route's circuit after a success. Caller holds _routeLock"""
+    if state['circuit'] != 'closed':
+        print(f"[Route] Circuit closed for {state['route']} @ {state['ip']}")
+    state['circuit'] = 'closed'
+    state['consecutiveFailures'] = 0
+    state['openedAt'] = None
+
+
+def routeAvailable(name, exclude=()):
+    """True if a model has a route outside exclude that its circuit breaker would admit or is trialing"""
+    excluded = {id(state) for state in exclude}
+    with _routeLock:
+        now = monotonic()
+        return any(id(state) not in excluded and (circuitAllows(state, now) or state['circuit'] == 'half-open')
+                   for state in getRouteCandidates(name))
+
+
+def routeWait(state, tokenCost):
+    """Seconds until a route can admit a request costing tokenCost, None if blocked on concurrency"""
+    if state['maxConcurrency'] is not None and state['outstanding'] >= state['maxConcurrency']:
+        return None
+    return max(bucketWait(state['requestBucket'], 1),
+               bucketWait(state['tokenBucket'], tokenCost))
+
+
+def acquireRoute(name, tokenCost=0, exclude=()):
+    """Reserves the least loaded admissible route for a model, blocking until one has capacity.
+
+    A route is admissible when its circuit breaker is not open, it is below
+    its max concurrency and its requests-per-minute and tokens-per-minute
+    buckets can cover the call. Routes in exclude are skipped so callers can
+    fail over. While a half-open trial is the only hope, callers wait up to
+    circuitTrialWait seconds for its outcome instead of failing. Must be
+    paired with releaseRoute."""
+    tStart = monotonic()
+    excluded = {id(state) for state in exclude}
+    with _routeLock:
+        while True:
+            now = monotonic()
+            routes = [state for state in getRouteCandidates(name) if id(state) not in excluded]
+            candidates = [state for state in routes if circuitAllows(state, now)]
+            if not candidates:
+                trialing = any(state['circuit'] == 'half-open' for state in routes)
+                if not trialing or now - tStart >= circuitTrialWait:
+                    raise ConnectionError(f"No healthy routes available for {name}")
+                # releaseRoute notifies once the trial closes or reopens the circuit
+                _routeLock.wait(timeout=min(circuitTrialWait - (now - tStart), routeAdmissionPoll))
+                continue
+
+            waits = []
+            for state in candidates:
+                refillBucket(state['requestBucket'], now)
+                refillBucket(state['tokenBucket'], now)
+                waits.append(routeWait(state, tokenCost))
+
+            admissible = [state for state, wait in zip(candidates, waits) if wait == 0]
+            if admissible:
+                break
+
+            pending = [wait for wait in waits if wait is not None]
+            _routeLock.wait(timeout=min(pending + [routeAdmissionPoll]))
+
+        state = min(admissible, key=routeScore)
+        if state['circuit'] == 'open':
+            state['circuit'] = 'half-open'
+        if state['requestBucket'] is not None:
+            state['requestBucket']['level'] -= 1
+        if state['tokenBucket'] is not None:
+            state['tokenBucket']['level'] -= min(tokenCost, state['tokenBucket']['capacity'])
+        state['outstanding'] += 1
+        state['requests'] += 1
+        state['waitSeconds'] += now - tStart
+        state['lastUsed'] = now
+    return state
+
+
+def releaseRoute(state, latency, success=True, tokenRefund=0, error=None):
+    """Returns a reserved route and folds the call latency into its moving average.
+
+    tokenRefund gives back tokens reserved at admission but not actually used.
+    A failed call with an error counts as a route fault for the circuit
+    breaker, one without (a rejected request) does not."""
+    with _routeLock:
+        state['outstanding'] -= 1
+        bucket = state['tokenBucket']
+        if bucket is not None and tokenRefund > 0:
+            bucket['level'] = min(bucket['capacity'], bucket['level'] + tokenRefund)
+        state['busySeconds'] += latency
+        if success:
+            resetCircuit(state)
+            if state['latency'] is None:
+                state['latency'] = latency
+            else:
+                state['latency'] += routeLatencyAlpha * (latency - state['latency'])
         else:
-            chosenIdx = temp.index[0]
-        routeRow = modelRoutes.loc[chosenIdx]
-    else:
-        chosenIdx = matches.index[0]
-        routeRow = modelRoutes.loc[chosenIdx]
+            state['failures'] += 1
+            if error is not None:
+                tripCircuit(state, monotonic(), error)
+            elif state['circuit'] == 'half-open':
+                state['circuit'] = 'open'
+        _routeLock.notify_all()
+
+
+llmPoolConfig = {'maxConnections': 64,
+                 'maxKeepalive': 32,
+                 'keepaliveExpiry': 120}
+_llmClient = None
+_llmClientLock = threading.Lock()
+
+
+def getLLMClient():
+    """Returns the shared keep-alive HTTP handler passed to litellm for local routes"""
+    global _llmClient
+    if _llmClient is None:
+        with _llmClientLock:
+            if _llmClient is None:
+                limits = httpx.Limits(max_connections=llmPoolConfig['maxConnections'],
+                                      max_keepalive_connections=llmPoolConfig['maxKeepalive'],
+                                      keepalive_expiry=llmPoolConfig['keepaliveExpiry'])
+                _llmClient = HTTPHandler(client=httpx.Client(limits=limits, timeout=None))
+    return _llmClient
+
+
+def configureHttpPools(maxConnections=None,
+                       maxKeepalive=None,
+                       poolConnections=None,
+                       poolMaxsize=None):
+    """Sets connection pool sizes for model endpoints and scraping, replacing the shared clients"""
+    global _llmClient
+    for key, value in [('maxConnections', maxConnections), ('maxKeepalive', maxKeepalive)]:
+        if value is not None:
+            llmPoolConfig[key] = value
+    with _llmClientLock:
+        _llmClient = None
+    st.configureHttpPool(poolConnections, poolMaxsize)
+
+
+def routeClientArgs(state):
+    """Completion kwargs that pin a route to the shared pooled client.
+
+    Only Ollama routes take a raw HTTP handler, other providers manage their own SDK clients."""
+    if str(state['route']).startswith(('ollama/', 'ollama_chat/')):
+        return {'client': getLLMClient()}
+    return {}
+
+
+def estimateTokens(messages, model, maxTokens=0):
+    """Estimates the prompt plus completion tokens a call may consume"""
+    try:
+        promptTokens = token_counter(model=model, messages=messages)
+    except Exception:
+        promptTokens = sum(len(str(message.get('content', ''))) for message in messages) // 4
+    return promptTokens + int(maxTokens)
+
+
+def getModelRoute(name):
+    """Model route accessor, returns the (route, ip) a new request would be sent to"""
+    with _routeLock:
+        now = monotonic()
+        candidates = getRouteCandidates(name)
+        healthy = [state for state in candidates if circuitAllows(state, now)]
+        state = min(healthy or candidates, key=routeScore)
+        state['lastUsed'] = monotonic()
+    return state['route'], state['ip']
+
+
+def getRouteStats():
+    """Returns a per-route utilization snapshot of the routing table"""
+    with _routeLock:
+        elapsed = max(monotonic() - _routeTableStart, 1e-9)
+        rows = [{'model': state['model'],
+                 'route': state['route'],
+                 'ip': state['ip'],
+                 'outstanding': state['outstanding'],
+                 'requests': state['requests'],
+                 'failures': state['failures'],
+                 'latency': state['latency'],
+                 'max concurrency': state['maxConcurrency'],
+                 'wait seconds': state['waitSeconds'],
+                 'utilization': state['busySeconds'] / elapsed,
+                 'circuit': state['circuit'],
+                 'consecutive failures': state['consecutiveFailures'],
+                 'healthy': state['healthy'],
+                 'last probe': state['lastProbe'],
+                 'last error': state['lastError']}
+                for states in routeTable.values() for state in states]
+    return pd.DataFrame(rows)
+
+
+#########################################
+#                                       #
+#      ROUTE HEALTH                     #
+#                                       #
+#########################################
+
+healthCheckInterval = 30.0
+healthCheckTimeout = 10
+_healthStop = threading.Event()
+_healthThread = None
+
+# Errors caused by the request itself, failing over to another route would not help
+requestFaults = (litellm.BadRequestError, litellm.UnprocessableEntityError)
+
+
+def isRouteFault(error):
+    """True if an LLM call error implicates the endpoint rather than the request"""
+    return not isinstance(error, requestFaults)
+
+
+def probeRoute(state, messages=None, tokens=1, timeout=healthCheckTimeout):
+    """Checks a single route and feeds the outcome to its circuit breaker.
+
+    Routes with an ip are pinged over HTTP, any non-5xx answer counts as up.
+    Remote routes, or any route when messages are given, get a real completion.
+    Returns (ok, response text or error)."""
+    try:
+        if messages is None and state['ip'] is not None:
+            response = st.getHttpSession().get(state['ip'], timeout=timeout)
+            if response.status_code >= 500:
+                raise ConnectionError(f"{state['ip']} returned status {response.status_code}")
+            result = response.text.strip()
+        else:
+            if messages is None:
+                messages = [{'role': 'user', 'content': 'ping'}]
+            content = completion(model=state['route'],
+                                 max_tokens=int(tokens),
+                                 messages=messages,
+                                 api_base=state['ip'],
+                                 timeout=timeout,
+                                 **routeClientArgs(state))
+            result = (content.choices[0].message.content or '').strip()
+        ok = True
+    except Exception as e:
+        result = e
+        ok = False
+
+    with _routeLock:
+        state['healthy'] = ok
+        state['lastProbe'] = datetime.utcnow()
+        if ok:
+            resetCircuit(state)
+        else:
+            # A failed probe is decisive, skip straight to an open circuit
+            state['consecutiveFailures'] = max(state['consecutiveFailures'], circuitFailureThreshold - 1)
+            tripCircuit(state, monotonic(), result)
+        _routeLock.notify_all()
+    return ok, result
+
+
+def probeRoutes(probeRemote=True, numWorkers=8):
+    """Probes every route in parallel and returns the route stats"""
+    with _routeLock:
+        states = [state for states in routeTable.values() for state in states
+                  if probeRemote or state['ip'] is not None]
+    if states:
+        with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+            list(executor.map(probeRoute, states))
+    return getRouteStats()
+
+
+def healthCheckLoop(interval, probeRemote):
+    while not _healthStop.is_set():
+        try:
+            probeRoutes(probeRemote=probeRemote)
+        except Exception as e:
+            print(f"[Route] Health check error: {e}")
+        _healthStop.wait(interval)
+
 
-    modelRoutes.at[chosenIdx, 'last used'] = datetime.utcnow()
+def startHealthChecks(interval=healthCheckInterval, probeRemote=False):
+    """Starts background route probes. Remote routes are skipped by default since probes cost a completion"""
+    global _healthThread
+    if _healthThread is not None and _healthThread.is_alive():
+        return _healthThread
+    _healthStop.clear()
+    _healthThread = threading.Thread(target=healthCheckLoop,
+                                     args=(interval, probeRemote),
+                                     name='tabulairity-health',
+                                     daemon=True)
+    _healthThread.start()
+    return _healthThread
 
-    return routeRow['route'], routeRow['ip']
+
+def stopHealthChecks():
+    """Stops background route probes"""
+    global _healthThread
+    _healthStop.set()
+    if _healthThread is not None:
+        _healthThread.join(timeout=healthCheckTimeout + 1)
+    _healthThread = None
+
+
+modelRoutes = prepEnvironment()
+buildRouteTable(modelRoutes)
 
 
 #########################################
@@ -489,6 +935,57 @@ def buildChatNet(script, show=False):
     else:
         script['extra_params'] = None
 
+    # Parse stop column: 'first_word', 'json' or 'regex:<pattern>', empty/null → None
+    if 'stop' in script.columns:
+        def parseStop(val):
+            if not isValid(val) or str(val).strip() == '':
+                return None
+            try:
+                getStopPredicate(val)
+                return str(val).strip()
+            except (ValueError, re.error) as e:
+                print(f"[Warning] Could not parse stop value: {val!r} ({e})")
+                return None
+        script['stop'] = script['stop'].apply(parseStop)
+    else:
+        script['stop'] = None
+
+    # Optional chunked mode columns: variable to split, reduce step and chunk size,
+    # and retrieval mode: 'retrieve:k' sends only the top k passages of long variables
+    for col in ['chunk', 'reduce', 'chunk_tokens', 'retrieve']:
+        if col not in script.columns:
+            script[col] = None
+
+    # Parse reduce column: a chunkReducers name, unknown values fall back to 'first'
+    def parseReduce(val):
+        if not isValid(val) or str(val).strip() == '':
+            return None
+        if str(val).strip() not in chunkReducers:
+            print(f"[Warning] Could not parse reduce value: {val!r} (expected one of {list(chunkReducers)}), using 'first'")
+            return 'first'
+        return str(val).strip()
+    script['reduce'] = script['reduce'].apply(parseReduce)
+
+    # Parse chunk_tokens column: a positive integer, otherwise None → defaultChunkTokens
+    def parseChunkTokens(val):
+        if not isValid(val) or str(val).strip() == '':
+            return None
+        try:
+            chunkTokens = float(val)
+        except (TypeError, ValueError):
+            chunkTokens = None
+        if chunkTokens is None or not chunkTokens.is_integer() or chunkTokens <= 0:
+            print(f"[Warning] Could not parse chunk_tokens value: {val!r}, using {defaultChunkTokens}")
+            return None
+        return int(chunkTokens)
+    # Built as object so parsed sizes stay ints next to None
+    script['chunk_tokens'] = pd.Series([parseChunkTokens(val) for val in script['chunk_tokens']],
+                                       index=script.index, dtype=object)
+
+    # Parse retrieve column: 'retrieve:k' or k with k a positive integer, otherwise None → no retrieval
+    script['retrieve'] = pd.Series([parseRetrieve(val) for val in script['retrieve']],
+                                   index=script.index, dtype=object)
+
     chatEdges = script[script.type == 'edge']
     chatNodes = script[script.type == 'node']
     G = nx.MultiDiGraph()
@@ -500,7 +997,12 @@ def buildChatNet(script, show=False):
                      'tokens': row['tokens'],
                      'self_eval': row['self_eval'],
                      'model': row['model'],
-                     'extra_params': row['extra_params']}) for index, row in chatNodes.T.items()]
+                     'extra_params': row['extra_params'],
+                     'stop': row['stop'],
+                     'chunk': row['chunk'],
+                     'reduce': row['reduce'],
+                     'chunk_tokens': row['chunk_tokens'],
+                     'retrieve': row['retrieve']}) for index, row in chatNodes.T.items()]
 
     G.add_nodes_from(nodesParsed)
 
@@ -566,18 +1068,54 @@ baseFx = {'isYes': lambda x, y: ynToBool(x),
           'pass': lambda x, y: x}
 
 
-def processNodeStep(currentNode, G, chatVars, fxStore, verbosity):
+def processNodeStep(currentNode, G, chatVars, fxStore, verbosity, walkId=None, queueWait=0.0):
+    """Process a single node, recording a trace span for it when tracing is enabled"""
+    if not tracingEnabled:
+        return runNodeStep(currentNode, G, chatVars, fxStore, verbosity)
+
+    # Tracing must never change whether a walk succeeds
+    try:
+        span = newSpan(currentNode, G, chatVars, walkId, queueWait)
+    except Exception as e:
+        print(f"[Trace] Could not open span for '{currentNode}': {e}")
+        return runNodeStep(currentNode, G, chatVars, fxStore, verbosity)
+
+    nextNodes = None
+    with recordCalls() as calls:
+        try:
+            nextNodes = runNodeStep(currentNode, G, chatVars, fxStore, verbosity, span)
+            return nextNodes
+        finally:
+            try:
+                finishSpan(span, calls, nextNodes)
+            except Exception as e:
+                print(f"[Trace] Could not record span for '{currentNode}': {e}")
+
+
+def runNodeStep(currentNode, G, chatVars, fxStore, verbosity, span=None):
     """Process a single node - FAIL FAST on errors to prevent garbage data propagation"""
     nodeVars = G.nodes[currentNode]
+    fxTimer = lambda: nullcontext() if span is None else spanTimer(span, 'fx_time')
 
     # --- BLOCK 1: PREPARATION ---
     try:
-        prompt = insertChatVars(nodeVars['prompt'], chatVars)
+        # Parsed once by buildChatNet
+        retrieveK = nodeVars.get('retrieve', None)
+        if isValid(retrieveK):
+            nodeStore = retrievePassageVars(nodeVars['prompt'], chatVars, retrieveK)
+        else:
+            nodeStore = chatVars
+        prompt = insertChatVars(nodeVars['prompt'], nodeStore)
         tokens = nodeVars['tokens']
         persona = nodeVars['persona']
         rowModel = nodeVars['model']
         selfEval = nodeVars['self_eval']
         extraParams = nodeVars.get('extra_params', None)
+        stop = nodeVars.get('stop', None)
+        if not isValid(stop):
+            stop = None
+        chunkVar = nodeVars.get('chunk', None)
+        chunked = isValid(chunkVar) and chunkVar in nodeStore
     except Exception:
         print(f"\n[ERROR] Node '{currentNode}' preparation failed")
         traceback.print_exc()
@@ -596,11 +1134,24 @@ def processNodeStep(currentNode, G, chatVars, fxStore, verbosity):
                 elif verbosity > 0:
                     print(f"   >>> Processing '{currentNode}' (Model: {rowModel})...")
 
-                chatResponse = askChatQuestion(prompt,
-                                                persona,
-                                                model=rowModel,
-                                                tokens=tokens,
-                                                extra_params=extraParams)
+                if chunked:
+                    chatResponse = askChunkedQuestion(nodeVars['prompt'],
+                                                      nodeStore,
+                                                      chunkVar,
+                                                      persona,
+                                                      model=rowModel,
+                                                      tokens=tokens,
+                                                      reduce=nodeVars.get('reduce'),
+                                                      chunkTokens=nodeVars.get('chunk_tokens'),
+                                                      extra_params=extraParams,
+                                                      stop=stop)
+                else:
+                    chatResponse = askChatQuestion(prompt,
+                                                    persona,
+                                                    model=rowModel,
+                                                    tokens=tokens,
+                                                    extra_params=extraParams,
+                                                    stop=stop)
 
                 if verbosity > 0:
                     print(f"   <<< Finished '{currentNode}': {chatResponse[:100]}...")
@@ -627,7 +1178,8 @@ def processNodeStep(currentNode, G, chatVars, fxStore, verbosity):
 
         if worthUsing:
             try:
-                cleanedResponse = fxStore[nodeVars['fx']](chatResponse, chatVars)
+                with fxTimer():
+                    cleanedResponse = fxStore[nodeVars['fx']](chatResponse, chatVars)
             except Exception as fxErr:
                 print(f"[Warning] Cleaning function {nodeVars['fx']} failed: {fxErr}")
                 cleanedResponse = chatResponse
@@ -644,7 +1196,8 @@ def processNodeStep(currentNode, G, chatVars, fxStore, verbosity):
         if not failed:
             edgesFromQ = G.out_edges([currentNode], data=True)
             for start, end, edgeData in edgesFromQ:
-                edgeResult = fxStore[edgeData['fx']](chatResponse, chatVars)
+                with fxTimer():
+                    edgeResult = fxStore[edgeData['fx']](chatResponse, chatVars)
                 chatVars[f'{start}-{end}'] = edgeResult
 
                 if str(edgeResult).lower() == 'true':
@@ -661,9 +1214,10 @@ def processNodeStep(currentNode, G, chatVars, fxStore, verbosity):
         raise  # Re-raise to stop entire graph
 
 
-async def process_one_node(node, G, chatVars, fxStore, verbosity, semaphore, workerID=0):
+async def process_one_node(node, G, chatVars, fxStore, verbosity, semaphore, workerID=0, walkId=None):
     """Process single node and return its children"""
     startTime = datetime.utcnow()
+    tQueued = monotonic()
     
     try:
         if verbosity >= 2:
@@ -678,7 +1232,9 @@ async def process_one_node(node, G, chatVars, fxStore, verbosity, semaphore, wor
                         G,
                         chatVars,
                         fxStore,
-                        verbosity
+                        verbosity,
+                        walkId,
+                        monotonic() - tQueued
                     ),
                     timeout=1500  # 15 minute max per node
                 )
@@ -704,6 +1260,7 @@ async def walkChatNetAsync(G, fxStore, varStore, verbosity, numWorkers=4):
     chatVars = deepcopy(varStore)
     fxStore = fxStore | baseFx
     semaphore = asyncio.Semaphore(numWorkers)
+    walkId = uuid.uuid4().hex if tracingEnabled else None
     
     currentWave = ['Start']
     waveNumber = 0
@@ -721,7 +1278,7 @@ async def walkChatNetAsync(G, fxStore, varStore, verbosity, numWorkers=4):
             tasks = []
             for idx, node in enumerate(currentWave):
                 task = asyncio.create_task(
-                    process_one_node(node, G, chatVars, fxStore, verbosity, semaphore, workerID=idx % numWorkers)
+                    process_one_node(node, G, chatVars, fxStore, verbosity, semaphore, workerID=idx % numWorkers, walkId=walkId)
                 )
                 tasks.append((node, task))
             
@@ -784,10 +1341,11 @@ def walkChatNet(G,
             toAsk = ['Start']
             fxStore = fxStore | baseFx
             chatVars = deepcopy(varStore)
+            walkId = uuid.uuid4().hex if tracingEnabled else None
 
             while toAsk != []:
                 nextQ = toAsk.pop()
-                nextNodes = processNodeStep(nextQ, G, chatVars, fxStore, verbosity)
+                nextNodes = processNodeStep(nextQ, G, chatVars, fxStore, verbosity, walkId)
                 toAsk += nextNodes
 
             return chatVars
@@ -797,6 +1355,277 @@ def walkChatNet(G,
         return varStore
 
 
+#########################################
+#                                       #
+#      CALL ACCOUNTING                  #
+#                                       #
+#########################################
+
+# LLM calls made inside recordCalls() blocks are logged to a thread-local
+# list, so callers can see real model latency and token use even when
+# answers come from the cache.
+
+_callRecorder = threading.local()
+
+
+@contextmanager
+def recordCalls(bypassCache=False):
+    """Collects a record for every LLM call made by this thread inside the block
+
+    Each record holds model, route, cached, latency (model seconds, taken
+    from the stored metadata on cache hits), wait (route queue seconds),
+    prompt_tokens and completion_tokens. With bypassCache, cached answers
+    are ignored and the calls re-run and re-cached."""
+    if not hasattr(_callRecorder, 'stack'):
+        _callRecorder.stack = []
+        _callRecorder.bypass = 0
+    calls = []
+    _callRecorder.stack.append(calls)
+    _callRecorder.bypass += bool(bypassCache)
+    try:
+        yield calls
+    finally:
+        # Nested recorders can hold equal lists, so remove by identity
+        stack = _callRecorder.stack
+        del stack[next(i for i in range(len(stack) - 1, -1, -1) if stack[i] is calls)]
+        _callRecorder.bypass -= bool(bypassCache)
+
+
+def isRecordingCalls():
+    """True inside a recordCalls() block on this thread"""
+    return bool(getattr(_callRecorder, 'stack', None))
+
+
+def isBypassingCache():
+    """True inside a recordCalls(bypassCache=True) block on this thread"""
+    return getattr(_callRecorder, 'bypass', 0) > 0
+
+
+def recordCall(**fields):
+    """Adds a call record to every active recorder on this thread"""
+    for calls in getattr(_callRecorder, 'stack', []):
+        calls.append(fields)
+
+
+def carryCallRecorders(fn):
+    """Wraps fn so LLM calls it makes on a worker thread reach this thread's active recorders"""
+    stack = list(getattr(_callRecorder, 'stack', []))
+    bypass = getattr(_callRecorder, 'bypass', 0)
+    if not stack and not bypass:
+        return fn
+
+    def run(*args, **kwargs):
+        previous = (getattr(_callRecorder, 'stack', None), getattr(_callRecorder, 'bypass', 0))
+        _callRecorder.stack = list(stack)
+        _callRecorder.bypass = bypass
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _callRecorder.stack, _callRecorder.bypass = previous
+            if _callRecorder.stack is None:
+                del _callRecorder.stack
+    return run
+
+
+def summarizeCalls(calls):
+    """Totals latency and token use over a list of call records"""
+    total = lambda field: sum(call.get(field) or 0 for call in calls)
+    return {'calls': len(calls),
+            'cache_hits': sum(bool(call.get('cached')) for call in calls),
+            'latency': total('latency'),
+            'wait': total('wait'),
+            'prompt_tokens': total('prompt_tokens'),
+            'completion_tokens': total('completion_tokens')}
+
+
+#########################################
+#                                       #
+#      NODE TRACING                     #
+#                                       #
+#########################################
+
+# With tracing enabled every processed node emits a span to an in-memory
+# collector (and optionally a JSONL file). Spans carry the LLM calls seen by
+# the call recorder, so cache hits, tokens and model latency are included.
+
+tracingEnabled = False
+traceExportPath = None
+traceDocVar = None
+traceMaxSpans = 200000
+traceSpans = []
+_traceLock = threading.Lock()
+
+
+def enableTracing(exportPath=None, docVar=None):
+    """Starts recording node spans, appending them to exportPath as JSONL if given
+
+    docVar names the chat var identifying the document a walk processes,
+    spans fall back to the walk id when it is missing."""
+    global tracingEnabled, traceExportPath, traceDocVar
+    traceExportPath = exportPath
+    traceDocVar = docVar
+    tracingEnabled = True
+
+
+def disableTracing():
+    """Stops recording node spans, keeping those already collected"""
+    global tracingEnabled
+    tracingEnabled = False
+
+
+def clearTraces():
+    """Empties the in-memory span collector"""
+    with _traceLock:
+        traceSpans.clear()
+
+
+def newSpan(node, G, chatVars, walkId, queueWait=0.0):
+    """Opens a span for one node execution"""
+    nodeVars = G.nodes[node]
+    docId = chatVars.get(traceDocVar) if traceDocVar is not None else None
+    return {'walk_id': walkId,
+            'doc_id': str(docId) if docId is not None else walkId,
+            'node': node,
+            'model': nodeVars.get('model'),
+            'route': None,
+            'start': time(),
+            'end': None,
+            'duration': None,
+            'queue_wait': queueWait,
+            'llm_latency': 0.0,
+            'fx_time': 0.0,
+            'calls': 0,
+            'cache_hits': 0,
+            'cache_hit': None,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'next': [],
+            'status': 'running',
+            '_t0': monotonic()}
+
+
+@contextmanager
+def spanTimer(span, field):
+    """Adds the seconds spent inside the block to span[field]"""
+    tStart = monotonic()
+    try:
+        yield
+    finally:
+        span[field] += monotonic() - tStart
+
+
+def finishSpan(span, calls, nextNodes):
+    """Closes a span with the node's recorded LLM calls and emits it"""
+    span['duration'] = monotonic() - span.pop('_t0')
+    span['end'] = span['start'] + span['duration']
+    summary = summarizeCalls(calls)
+    uncached = [call for call in calls if not call.get('cached')]
+    span['llm_latency'] = sum(call.get('latency') or 0 for call in uncached)
+    span['queue_wait'] += summary['wait']
+    span['calls'] = summary['calls']
+    span['cache_hits'] = summary['cache_hits']
+    span['cache_hit'] = summary['cache_hits'] == summary['calls'] if calls else None
+    span['prompt_tokens'] = summary['prompt_tokens']
+    span['completion_tokens'] = summary['completion_tokens']
+    routes = list(dict.fromkeys(call.get('route') for call in calls if call.get('route')))
+    span['route'] = ','.join(routes) if routes else None
+    span['next'] = list(nextNodes) if nextNodes is not None else []
+    span['status'] = 'ok' if nextNodes is not None else 'error'
+    emitSpan(span)
+
+
+def emitSpan(span):
+    """Adds a span to the collector and the JSONL export file"""
+    with _traceLock:
+        traceSpans.append(span)
+        if len(traceSpans) > traceMaxSpans:
+            del traceSpans[:len(traceSpans) - traceMaxSpans]
+        if traceExportPath is not None:
+            with open(traceExportPath, 'a') as traceFile:
+                traceFile.write(json.dumps(span, default=str) + '\n')
+
+
+def getTraceSpans():
+    """Returns the collected spans as a DataFrame"""
+    with _traceLock:
+        return pd.DataFrame(list(traceSpans))
+
+
+def exportTraces(path, spans=None):
+    """Writes spans (the collector by default) to a JSONL file"""
+    if spans is None:
+        with _traceLock:
+            spans = list(traceSpans)
+    elif isinstance(spans, pd.DataFrame):
+        spans = spans.to_dict('records')
+    with open(path, 'w') as traceFile:
+        for span in spans:
+            traceFile.write(json.dumps(span, default=str) + '\n')
+
+
+def loadTraces(path):
+    """Reads a JSONL span export into a DataFrame"""
+    return pd.read_json(path, lines=True)
+
+
+def criticalPath(spans=None):
+    """Finds the longest dependent chain of node spans in each walk
+
+    A span depends on an earlier span in the same walk that listed its node
+    as a next node and finished before it started. Returns one row per walk
+    with the path, its summed node seconds and the walk's wall seconds."""
+    if spans is None:
+        spans = getTraceSpans()
+    rows = []
+    for walkId, walk in spans.groupby('walk_id', sort=False):
+        walk = walk.sort_values('start').to_dict('records')
+        cost = []
+        back = []
+        for i, span in enumerate(walk):
+            parents = [j for j in range(i)
+                       if span['node'] in walk[j]['next'] and walk[j]['end'] <= span['start'] + 1e-6]
+            best = max(parents, key=lambda j: cost[j], default=None)
+            cost.append(span['duration'] + (cost[best] if best is not None else 0.0))
+            back.append(best)
+        last = max(range(len(walk)), key=lambda i: cost[i])
+        path = []
+        while last is not None:
+            path.append(walk[last]['node'])
+            last = back[last]
+        rows.append({'walk_id': walkId,
+                     'doc_id': walk[0]['doc_id'],
+                     'path': path[::-1],
+                     'path_seconds': max(cost),
+                     'walk_seconds': max(span['end'] for span in walk) - walk[0]['start'],
+                     'nodes': len(walk)})
+    return pd.DataFrame(rows)
+
+
+def nodeLatencyStats(spans=None):
+    """Aggregates span timings per node across a run, slowest total time first
+
+    critical_share is the fraction of walks whose critical path includes
+    the node, the best hint for which nodes to optimize or fuse."""
+    if spans is None:
+        spans = getTraceSpans()
+    stats = spans.groupby('node').agg(runs=('duration', 'size'),
+                                      total_seconds=('duration', 'sum'),
+                                      mean_seconds=('duration', 'mean'),
+                                      p95_seconds=('duration', lambda x: x.quantile(0.95)),
+                                      mean_llm_latency=('llm_latency', 'mean'),
+                                      mean_queue_wait=('queue_wait', 'mean'),
+                                      mean_fx_time=('fx_time', 'mean'),
+                                      prompt_tokens=('prompt_tokens', 'sum'),
+                                      completion_tokens=('completion_tokens', 'sum'),
+                                      calls=('calls', 'sum'),
+                                      cache_hits=('cache_hits', 'sum'))
+    stats['cache_hit_rate'] = stats.cache_hits / stats.calls.where(stats.calls > 0)
+    paths = criticalPath(spans)
+    onPath = Counter(node for path in paths.path for node in set(path))
+    stats['critical_share'] = [onPath[node] / max(len(paths), 1) for node in stats.index]
+    return stats.sort_values('total_seconds', ascending=False)
+
+
 #########################################
 #                                       #
 #      QUERY CACHING FUNCTIONS          #
@@ -841,11 +1670,15 @@ def queryToCache(cacheKey,
         kwargs = {}
 
     queryHash = getHash(cacheKey)
+    metadataKey = f"callMetadata({cacheKey})"
 
     # --- READ FROM CACHE ---
-    if useCache:
+    if useCache and not isBypassingCache():
         cached = cacheGet(queryHash)
         if cached is not None:
+            if isRecordingCalls():
+                metadata = cacheGet(getHash(metadataKey)) or {}
+                recordCall(**(metadata | {'cached': True, 'wait': 0.0}))
             return cached
 
     # --- EXECUTE QUERY ---
@@ -854,41 +1687,147 @@ def queryToCache(cacheKey,
     attempts = 0
     result = None
 
-    while not gotResults and attempts < maxAttempts:
-        if tolerant:
-            try:
+    with recordCalls() as calls:
+        while not gotResults and attempts < maxAttempts:
+            if tolerant:
+                try:
+                    result = fn(*args, **kwargs)
+                    gotResults = True
+                except Exception:
+                    attempts += 1
+                    sleep(5)
+            else:
                 result = fn(*args, **kwargs)
                 gotResults = True
-            except Exception:
-                attempts += 1
-                sleep(5)
-        else:
-            result = fn(*args, **kwargs)
-            gotResults = True
-            attempts = maxAttempts
+                attempts = maxAttempts
 
     # --- WRITE TO CACHE ---
     if gotResults:
         cacheSet(queryHash, cacheKey, result)
+        if calls:
+            # Keep what the uncached call cost so later hits can report it
+            summary = summarizeCalls(calls)
+            cacheSet(getHash(metadataKey), metadataKey, {'model': calls[-1].get('model'),
+                                                         'route': calls[-1].get('route'),
+                                                         'latency': summary['latency'],
+                                                         'prompt_tokens': summary['prompt_tokens'],
+                                                         'completion_tokens': summary['completion_tokens']})
 
     return result
 
 
 def scrapePage(url):
-    """Fetch webpage content"""
-    response = requests.get(url)
-    statusCode = response.status_code
+    """Fetch webpage content, capped at st.maxPageBytes"""
+    try:
+        page = st.fetchPage(url)
+    except requests.exceptions.HTTPError as e:
+        raise ValueError(f"Page returned status {e.response.status_code}")
+    statusCode = page['statusCode']
     if statusCode == 200:
-        return response.text
+        return page['text']
     else:
         raise ValueError(f"Page returned status {statusCode}")
 
 
-def cachePage(url, maxLen = 100000):
-    """Cached page scraping"""
+# Seconds before a cached page is revalidated with its server, None never revalidates
+pageMaxAge = None
+
+
+def getFreshPage(url, maxLen = 100000, maxAge = None):
+    """Returns (cached text, validators), text is None if missing or older than maxAge"""
+    if maxAge is None:
+        maxAge = pageMaxAge
+    if not useCache:
+        return None, None
+
+    text = cacheGet(getHash(f"st.scrapePageText('{url}',maxLen={maxLen})"))
+    if text is None or maxAge is None:
+        return text, None
+
+    validators = cacheGet(getHash(f"pageValidators('{url}',maxLen={maxLen})"))
+    if validators is None:
+        return None, {'text': text}
+    age = (datetime.utcnow() - datetime.fromisoformat(validators['fetched'])).total_seconds()
+    if age < maxAge:
+        return text, validators
+    return None, validators | {'text': text}
+
+
+def cachePage(url, maxLen = 100000, politeDelay = (0.5, 1.5), maxAge = None):
+    """Cached page scraping.
+
+    Pages cached longer than maxAge (default pageMaxAge) seconds are
+    revalidated with a conditional GET on their ETag/Last-Modified, so
+    unchanged pages are neither downloaded nor parsed again."""
+    text, validators = getFreshPage(url, maxLen, maxAge)
+    if text is not None:
+        return text
+
     cacheKey = f"st.scrapePageText('{url}',maxLen={maxLen})"
-    result = queryToCache(cacheKey, st.scrapePageText, args=(url,), kwargs={'maxLen': maxLen})
-    return result
+    validatorKey = f"pageValidators('{url}',maxLen={maxLen})"
+    result = st.scrapePageTextConditional(url, maxLen, validators, politeDelay)
+
+    if result['status'] == 'error' and validators is not None:
+        # Keep serving the stale copy rather than replacing it with an error
+        return validators['text']
+
+    cacheSet(getHash(cacheKey), cacheKey, result['text'])
+    if result['status'] != 'error':
+        cacheSet(getHash(validatorKey), validatorKey, {'etag': result['etag'],
+                                                       'lastModified': result['lastModified'],
+                                                       'contentHash': result['contentHash'],
+                                                       'fetched': datetime.utcnow().isoformat()})
+    return result['text']
+
+
+def cachePages(urls,
+               maxLen = 100000,
+               numWorkers = 16,
+               domainConcurrency = 2,
+               domainDelay = 1.0,
+               maxAge = None):
+    """Cached bulk page scraping with per-domain politeness, results follow input order.
+
+    Cache hits return immediately. Fetches run on up to numWorkers threads
+    with at most domainConcurrency in flight per domain, and successive
+    fetch starts on a domain spaced by domainDelay (jittered 0.5-1.5x)."""
+    urls = list(urls)
+    domains = dict()
+    domainsLock = threading.Lock()
+
+    def getDomain(url):
+        domain = urlparse(str(url)).netloc.lower()
+        with domainsLock:
+            if domain not in domains:
+                domains[domain] = {'semaphore': threading.Semaphore(domainConcurrency),
+                                   'lock': threading.Lock(),
+                                   'nextStart': 0.0}
+            return domains[domain]
+
+    def fetch(url):
+        cached, _ = getFreshPage(url, maxLen, maxAge)
+        if cached is not None:
+            return cached
+
+        domain = getDomain(url)
+        with domain['semaphore']:
+            with domain['lock']:
+                now = monotonic()
+                wait = max(domain['nextStart'] - now, 0.0)
+                domain['nextStart'] = now + wait + domainDelay * uniform(0.5, 1.5)
+            sleep(wait)
+            return cachePage(url, maxLen, politeDelay=None, maxAge=maxAge)
+
+    # Interleave domains so one large domain does not hold every worker
+    byDomain = OrderedDict()
+    for url in dict.fromkeys(urls):
+        byDomain.setdefault(urlparse(str(url)).netloc.lower(), []).append(url)
+    order = [url for group in zip_longest(*byDomain.values()) for url in group if url is not None]
+
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        futures = {url: executor.submit(fetch, url) for url in order}
+        fetched = {url: future.result() for url, future in futures.items()}
+    return [fetched[url] for url in urls]
 
 
 def cacheGeocode(locText):
@@ -924,12 +1863,22 @@ def getLanguageName(code):
     return lang.name if lang else "English"
 
 
-def translateOne(text):
-    """Translate text to target language"""
+def translationQuery(text):
+    """Returns the (prompt, persona) used to translate one piece of text"""
     languageName = getLanguageName(targetLanguage)
     translationPersona = f"You are a highly accurate and fluent {languageName} translator."
     translationPrompt = f"Translate the following text to {languageName}. Output only the translated text. Do not include any markdown, explanations, commentary, variable placeholders, or descriptive text.\n\n{text.strip()}"
+    return translationPrompt, translationPersona
 
+
+def translationCacheKey(text):
+    """Cache key translateChunk stores the translation of text under"""
+    return chatCacheKey(*translationQuery(text), tokens=maxTranslateTokens, model=translationModel)[1]
+
+
+def translateChunk(text):
+    """Translates one piece of text in a single request"""
+    translationPrompt, translationPersona = translationQuery(text)
     translation = askChatQuestion(translationPrompt,
                                   translationPersona,
                                   tokens=maxTranslateTokens,
@@ -937,16 +1886,186 @@ def translateOne(text):
     return translation
 
 
+def translateOne(text):
+    """Translate text to target language
+
+    Texts longer than translateChunkTokens are split on paragraph and
+    sentence boundaries and the chunks translated concurrently, each cached
+    on its own so an edited document only re-translates changed chunks."""
+    chunks = splitTextByTokens(text, translationModel, translateChunkTokens, withSeparators=True)
+    if len(chunks) <= 1:
+        return translateChunk(text)
+
+    with ThreadPoolExecutor(max_workers=min(translateWorkers, len(chunks))) as executor:
+        translations = list(executor.map(carryCallRecorders(translateChunk), [chunk for chunk, separator in chunks]))
+    # Rejoin on the break each chunk was split at so paragraphs stay paragraphs
+    return ''.join(separator + str(translation).strip()
+                   for (chunk, separator), translation in zip(chunks, translations))
+
+
+# langdetect samples randomly unless seeded, making repeat runs disagree
+DetectorFactory.seed = 0
+
+languageConfidence = 0.8
+languageMinLetters = 5
+languageWorkers = 4
+languageProcessMin = 5000
+languageCacheSize = 100000
+_languageCache = OrderedDict()
+_languageLock = threading.Lock()
+
+
+def detectLanguageScored(text):
+    """Returns (language code, probability) for text, ('unidentified', 0.0) if undetectable"""
+    if not isinstance(text, str) or sum(char.isalpha() for char in text) < languageMinLetters:
+        # Too short to detect reliably, langdetect is confidently wrong on these
+        return "unidentified", 0.0
+    try:
+        best = detect_langs(text)[0]
+        return best.lang, best.prob
+    except LangDetectException:
+        return "unidentified", 0.0
+
+
+def detectLanguages(texts, minConfidence=None, numWorkers=None):
+    """Detects the language of each text, returning a list aligned with texts
+
+    Values are deduplicated and their scores kept in an LRU so repeated
+    titles are only scored once. Detections below minConfidence come back
+    as 'unidentified', as do texts with fewer than languageMinLetters
+    letters. With more than languageProcessMin new values the
+    scoring is spread over numWorkers processes."""
+    if minConfidence is None:
+        minConfidence = languageConfidence
+    if numWorkers is None:
+        numWorkers = languageWorkers
+    texts = list(texts)
+    unique = list(dict.fromkeys(text if isinstance(text, str) else None for text in texts))
+
+    scores = dict()
+    with _languageLock:
+        for text in unique:
+            if text in _languageCache:
+                _languageCache.move_to_end(text)
+                scores[text] = _languageCache[text]
+    missing = [text for text in unique if text not in scores]
+
+    if numWorkers > 1 and len(missing) > languageProcessMin:
+        with ProcessPoolExecutor(max_workers=numWorkers) as executor:
+            found = list(executor.map(detectLanguageScored, missing,
+                                      chunksize=max(len(missing) // (numWorkers * 4), 1)))
+    else:
+        found = [detectLanguageScored(text) for text in missing]
+    scores.update(zip(missing, found))
+
+    with _languageLock:
+        _languageCache.update(zip(missing, found))
+        while len(_languageCache) > languageCacheSize:
+            _languageCache.popitem(last=False)
+
+    languages = []
+    for text in texts:
+        language, prob = scores[text if isinstance(text, str) else None]
+        languages.append(language if prob >= minConfidence else "unidentified")
+    return languages
+
+
 def getLanguage(text):
     """Detect language of text"""
-    if text in {'', None, np.nan}:
-        language = "unidentified"
-    else:
-        try:
-            language = detect(text)
-        except:
-            language = "unidentified"
-    return language
+    return detectLanguages([text])[0]
+
+
+def translateBatch(texts):
+    """Translates a list of short texts in one request, packed as a JSON array
+
+    Falls back to translating each text on its own if the reply does not
+    parse as an array of strings matching the input."""
+    languageName = getLanguageName(targetLanguage)
+    translationPersona = f"You are a highly accurate and fluent {languageName} translator."
+    translationPrompt = (f"Translate each string in the following JSON array to {languageName}. "
+                         f"Output only a JSON array of the {len(texts)} translated strings in the same order. "
+                         "Do not include any markdown, explanations, commentary, variable placeholders, or descriptive text.\n\n"
+                         + json.dumps([text.strip() for text in texts], ensure_ascii=False))
+
+    translation = askChatQuestion(translationPrompt,
+                                  translationPersona,
+                                  tokens=maxTranslateTokens,
+                                  model=translationModel)
+    try:
+        translated = json.loads(stopJson(str(translation), final=True) or 'null')
+    except json.JSONDecodeError:
+        translated = None
+    if (isinstance(translated, list) and len(translated) == len(texts)
+            and all(isinstance(item, str) for item in translated)):
+        # Store each text under its translateOne key so later single or batched lookups hit
+        for text, item in zip(texts, translated):
+            cacheKey = translationCacheKey(text)
+            cacheSet(getHash(cacheKey), cacheKey, item)
+        return translated
+
+    print(f"[Translate] Batch of {len(texts)} did not parse, translating individually")
+    return [translateOne(text) for text in texts]
+
+
+def packTranslationBatches(texts):
+    """Groups short texts into batches bounded by translateBatchTokens and translateBatchItems"""
+    batches = []
+    current = []
+    currentTokens = 0
+    for text in texts:
+        textTokens = countTokens(text, translationModel)
+        if current and (currentTokens + textTokens > translateBatchTokens or len(current) >= translateBatchItems):
+            batches.append(current)
+            current, currentTokens = [], 0
+        current.append(text)
+        currentTokens += textTokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def cachedTranslations(texts):
+    """Returns {text: translation} for texts already cached by translateOne or a batch"""
+    if not useCache or isBypassingCache() or not texts:
+        return dict()
+    keys = {text: translationCacheKey(text) for text in texts}
+    found = cacheGetMany([getHash(key) for key in keys.values()])
+    hits = {text: found[getHash(key)] for text, key in keys.items() if getHash(key) in found}
+    if hits and isRecordingCalls():
+        metadataKeys = {text: f"callMetadata({keys[text]})" for text in hits}
+        metadata = cacheGetMany([getHash(key) for key in metadataKeys.values()])
+        for text in hits:
+            recordCall(**(metadata.get(getHash(metadataKeys[text]), {}) | {'cached': True, 'wait': 0.0}))
+    return hits
+
+
+def translateMany(texts, numWorkers=None):
+    """Translates texts, returning {text: translation}
+
+    Texts are deduplicated and short ones already translated are read from
+    the cache. The remaining short ones are packed into batched requests and
+    long ones go through translateOne. Requests run concurrently across
+    numWorkers threads. Blank and non-string values map to themselves."""
+    if numWorkers is None:
+        numWorkers = translateWorkers
+    unique = [text for text in dict.fromkeys(texts)
+              if isinstance(text, str) and text.strip() != '']
+    short = [text for text in unique if countTokens(text, translationModel) <= translateItemTokens]
+    shortSet = set(short)
+    long = [text for text in unique if text not in shortSet]
+
+    translations = {text: text for text in texts if not isinstance(text, str) or text.strip() == ''}
+    translations.update(cachedTranslations(short))
+    short = [text for text in short if text not in translations]
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        batchFutures = {tuple(batch): executor.submit(carryCallRecorders(translateBatch), batch)
+                        for batch in packTranslationBatches(short)}
+        longFutures = {text: executor.submit(carryCallRecorders(translateOne), text) for text in long}
+        for batch, future in batchFutures.items():
+            translations.update(zip(batch, future.result()))
+        for text, future in longFutures.items():
+            translations[text] = future.result()
+    return translations
 
 
 def autoTranslate(dfIn,
@@ -957,13 +2076,132 @@ def autoTranslate(dfIn,
     df = dfIn.copy(deep=True)
     langOut = f'{column}_language'
     textOut = f'{column}_translated'
-    df.loc[:, langOut] = df[column].apply(getLanguage)
+    df.loc[:, langOut] = detectLanguages(df[column])
     df.loc[:, textOut] = df[column]
-    df.loc[df[langOut] != targetLanguage, textOut] = df.loc[df[langOut] != targetLanguage, textOut].apply(translateOne)
+    # Unidentified covers blanks and low confidence detections, not worth a translation call
+    needsTranslation = ~df[langOut].isin([targetLanguage, "unidentified"])
+    toTranslate = df.loc[needsTranslation, column].tolist()
+    translations = translateMany(toTranslate)
+    df.loc[needsTranslation, textOut] = [translations.get(text, text) for text in toTranslate]
 
     return df
 
 
+#########################################
+#                                       #
+#      STREAMING STOP PREDICATES        #
+#                                       #
+#########################################
+
+# Stop predicates take the streamed text so far and whether the stream has
+# ended, returning the final trimmed answer once one is available or None to
+# keep reading. They only fire on text followed by more output so partial
+# tokens are never cut short.
+
+
+def stopFirstWord(text, final=False):
+    """Stops once the first complete word has been streamed"""
+    match = re.match(r'[\W_]*(\w+)(\W|$)', text)
+    if match and (match.group(2) or final):
+        return match.group(1)
+    return None
+
+
+def stopJson(text, final=False):
+    """Stops once the first JSON object or array in the stream is closed and parses"""
+    starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+    if not starts:
+        return None
+    start = min(starts)
+    depth = 0
+    inString = False
+    escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if inString:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                inString = False
+        elif char == '"':
+            inString = True
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                candidate = text[start:i + 1]
+                try:
+                    json.loads(candidate)
+                    return candidate
+                except json.JSONDecodeError:
+                    return None
+    return None
+
+
+def stopRegex(pattern):
+    """Returns a predicate that stops on the first match of pattern"""
+    compiled = re.compile(pattern)
+
+    def predicate(text, final=False):
+        match = compiled.search(text)
+        if match and (match.end() < len(text) or final):
+            return match.group(0)
+        return None
+
+    return predicate
+
+
+stopPredicates = {'first_word': stopFirstWord,
+                  'json': stopJson}
+
+
+def getStopPredicate(spec):
+    """Resolves a node stop spec ('first_word', 'json' or 'regex:<pattern>') to a predicate"""
+    if spec is None:
+        return None
+    spec = str(spec).strip()
+    if spec.startswith('regex:'):
+        return stopRegex(spec[6:])
+    if spec in stopPredicates:
+        return stopPredicates[spec]
+    raise ValueError(f"Unknown stop predicate: {spec!r}")
+
+
+def readStream(response, predicate=None):
+    """Consumes a streamed completion, closing it early once predicate yields an answer"""
+    text = ''
+    for chunk in response:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        text += delta
+        if predicate is not None:
+            answer = predicate(text)
+            if answer is not None:
+                closeStream(response)
+                return answer.strip()
+
+    if predicate is not None:
+        answer = predicate(text, final=True)
+        if answer is not None:
+            return answer.strip()
+    return text.strip()
+
+
+def closeStream(response):
+    """Closes the underlying connection so the endpoint stops generating"""
+    stream = getattr(response, 'completion_stream', response)
+    close = getattr(stream, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
 #########################################
 #                                       #
 #      CHAT QUERIES                     #
@@ -973,19 +2211,33 @@ def autoTranslate(dfIn,
 
 def testRoutes(query='How many Rs are there in strawberry?',
                persona='an AI assistant',
-               autoformatPersona=True):
-    """Test all model routes"""
+               autoformatPersona=True,
+               tokens=200,
+               numWorkers=8):
+    """Test all model routes in parallel, returns the models with at least one working route"""
+    if autoformatPersona is True and persona.strip()[-1] != '.':
+        personaText = f'You are {persona}. You must answer questions as {persona}.'
+    else:
+        personaText = persona
+    messages = [{'role': 'system', 'content': personaText},
+                {'role': 'user', 'content': query}]
+
+    with _routeLock:
+        states = [state for model in sorted(routeTable) for state in routeTable[model]]
+
+    probe = lambda state: probeRoute(state, messages=messages, tokens=tokens, timeout=600)
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        results = list(executor.map(probe, states))
+
     working = []
-    for model in modelRoutes.index.sort_values():
-        try:
-            response = askChatQuestion(query,
-                                       persona,
-                                       autoformatPersona=autoformatPersona,
-                                       model=model)
-            print(f'{model} ~ {response}\n')
-            working.append(model)
-        except:
-            print(f'{model} ~ FAILS\n')
+    for state, (ok, response) in zip(states, results):
+        label = f"{state['model']} ({state['route']} @ {state['ip'] or 'remote'})"
+        if ok:
+            print(f'{label} ~ {response}\n')
+            if state['model'] not in working:
+                working.append(state['model'])
+        else:
+            print(f'{label} ~ FAILS: {str(response)[:200]}\n')
     return working
 
 
@@ -995,38 +2247,77 @@ def getChatContent(messages,
                    temperature=None,
                    seed=None,
                    timeout=600,
-                   extra_params=None):
-    """Get completion from LLM with timeout - FAIL FAST on errors"""
-    modelRoute, ip = getModelRoute(modelName)
-    
-    try:
-        content = completion(
-            model=modelRoute,
-            max_tokens=int(tokens),
-            messages=messages,
-            api_base=ip,
-            seed=seed,
-            temperature=temperature,
-            timeout=timeout,
-            **({"extra_body": extra_params} if extra_params else {})
-        )
-        cleaned = content.choices[0].message.content.strip() if content.choices[0].message.content else ''
-        return cleaned
-    except Exception as e:
-        # Fail immediately - don't retry with garbage data downstream
-        raise e
-
-
-def askChatQuestion(prompt,
-                    persona,
-                    model=modelName,
-                    autoformatPersona=None,
-                    tokens=2000,
-                    temperature=None,
-                    seed=None,
-                    extra_params=None):
-    """Ask a question to the chat model"""
+                   extra_params=None,
+                   stream=False,
+                   stop=None):
+    """Get completion from LLM with timeout - FAIL FAST on errors
+
+    With stream or a stop spec the completion is streamed, and a stop
+    predicate ends generation as soon as its answer is complete."""
+    predicate = getStopPredicate(stop)
+    stream = stream or predicate is not None
+    tokenCost = estimateTokens(messages, modelName, tokens)
+    triedRoutes = []
+
+    while True:
+        tQueued = monotonic()
+        routeState = acquireRoute(modelName, tokenCost, exclude=triedRoutes)
+        tStart = monotonic()
 
+        try:
+            content = completion(
+                model=routeState['route'],
+                max_tokens=int(tokens),
+                messages=messages,
+                api_base=routeState['ip'],
+                seed=seed,
+                temperature=temperature,
+                timeout=timeout,
+                **routeClientArgs(routeState),
+                **({"stream": True} if stream else {}),
+                **({"extra_body": extra_params} if extra_params else {})
+            )
+            if stream:
+                cleaned = readStream(content, predicate)
+            else:
+                cleaned = content.choices[0].message.content.strip() if content.choices[0].message.content else ''
+            break
+        except Exception as e:
+            routeFault = isRouteFault(e)
+            releaseRoute(routeState,
+                         monotonic() - tStart,
+                         success=False,
+                         error=e if routeFault else None)
+            triedRoutes.append(routeState)
+            # Fail over to an alternate healthy route, otherwise fail fast
+            if not routeFault or not routeAvailable(modelName, exclude=triedRoutes):
+                raise e
+            print(f"[Route] {routeState['route']} @ {routeState['ip']} failed ({type(e).__name__}), failing over...")
+
+    latency = monotonic() - tStart
+    usage = getattr(content, 'usage', None)
+    tokensUsed = getattr(usage, 'total_tokens', None) or tokenCost
+    releaseRoute(routeState, latency, tokenRefund=tokenCost - tokensUsed)
+    recordCall(model=modelName,
+               route=routeState['route'],
+               cached=False,
+               latency=latency,
+               wait=tStart - tQueued,
+               prompt_tokens=getattr(usage, 'prompt_tokens', None) or tokenCost - int(tokens),
+               completion_tokens=getattr(usage, 'completion_tokens', None) or countTokens(cleaned, modelName))
+    return cleaned
+
+
+def chatCacheKey(prompt,
+                 persona,
+                 model=modelName,
+                 autoformatPersona=None,
+                 tokens=2000,
+                 temperature=None,
+                 seed=None,
+                 extra_params=None,
+                 stop=None):
+    """Returns the (messages, cacheKey) askChatQuestion uses for these arguments"""
     if autoformatPersona is True and persona.strip()[-1] != '.':
         personaText = f'You are {persona}. You must answer questions as {persona}.'
     else:
@@ -1038,11 +2329,28 @@ def askChatQuestion(prompt,
     ]
 
     cacheKey = f"getChatContent({messages},{tokens},'{model}',{temperature},{seed},timeout=600,extra_params={repr(extra_params)})"
+    if stop is not None:
+        cacheKey += f",stop={stop!r}"
+    return messages, cacheKey
+
+
+def askChatQuestion(prompt,
+                    persona,
+                    model=modelName,
+                    autoformatPersona=None,
+                    tokens=2000,
+                    temperature=None,
+                    seed=None,
+                    extra_params=None,
+                    stop=None):
+    """Ask a question to the chat model, stop optionally names a streaming stop predicate"""
+    messages, cacheKey = chatCacheKey(prompt, persona, model, autoformatPersona, tokens,
+                                      temperature, seed, extra_params, stop)
     result = queryToCache(
         cacheKey,
         getChatContent,
         args=(messages, tokens, model),
-        kwargs={'temperature': temperature, 'seed': seed, 'timeout': 600, 'extra_params': extra_params},
+        kwargs={'temperature': temperature, 'seed': seed, 'timeout': 600, 'extra_params': extra_params, 'stop': stop},
         tolerant=False,
     )
     return result
@@ -1101,12 +2409,65 @@ def evaluateAuthor(response):
     return result
 
 
+fusedSelfEval = True
+yesWords = {'yes', 'true'}
+noWords = {'no', 'false'}
+
+
+def localYN(text):
+    """Standardizes a yes/no answer without a model call, returning None unless it leads with yes/no or is a boolean"""
+    if isinstance(text, bool):
+        return 'yes' if text else 'no'
+    match = re.match(r'\W*([a-z]+)\b', str(text).lower())
+    if match is None:
+        return None
+    if match.group(1) in yesWords:
+        return 'yes'
+    if match.group(1) in noWords:
+        return 'no'
+    return None
+
+
+def evaluateUsefulness(question, response):
+    """Judges in one call whether response answers question and whether its author identifies as an AI
+
+    Returns (answerYN, authorYN), or None if the reply does not parse."""
+    messages = [
+        {'role': 'system',
+         'content': 'You are a debate moderator skilled at identifying the presence of answer in long statements. You only reply with JSON.'},
+        {'role': 'user',
+         'content': f'Reply with a JSON object with two boolean fields: "answers_question", whether the following answer provides any useable answer for the provided question, and "identifies_as_ai", whether the author of the answer includes any text specifically identifying itself as an AI.\nquestion: {question}\nanswer: {response}'}
+    ]
+
+    cacheKey = f"getChatContent({messages},60,'{modelName}',stop='json')"
+    result = queryToCache(cacheKey, getChatContent, args=(messages, 60, modelName), kwargs={'stop': 'json'})
+    try:
+        judgement = json.loads(stopJson(str(result), final=True) or 'null')
+        answerYN = localYN(judgement['answers_question'])
+        authorYN = localYN(judgement['identifies_as_ai'])
+    except (json.JSONDecodeError, TypeError, KeyError):
+        return None
+    if answerYN is None or authorYN is None:
+        return None
+    return answerYN, authorYN
+
+
 def isUseful(question, response):
-    """Determine if response is useful"""
-    answerEval = evaluateAnswer(question, response)
-    authorEval = evaluateAuthor(response)
-    answerYN = getYN(answerEval)
-    authorYN = getYN(authorEval)
+    """Determine if response is useful
+
+    Both judgements come from one fused call when fusedSelfEval is set,
+    otherwise (or if it fails to parse) the two evaluations run concurrently
+    and are standardized locally, only asking getYN when ambiguous."""
+    judgement = evaluateUsefulness(question, response) if fusedSelfEval else None
+    if judgement is None:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            answerEval = executor.submit(carryCallRecorders(evaluateAnswer), question, response)
+            authorEval = executor.submit(carryCallRecorders(evaluateAuthor), response)
+            answerEval, authorEval = answerEval.result(), authorEval.result()
+        answerYN = localYN(answerEval) or getYN(answerEval)
+        authorYN = localYN(authorEval) or getYN(authorEval)
+    else:
+        answerYN, authorYN = judgement
     print(f'is answer:{answerYN}\tis AI: {authorYN}')
 
     result = answerYN == 'yes' and authorYN == 'no'
@@ -1123,4 +2484,388 @@ def getColor(text):
 
     cacheKey = f"getChatContent({messages},3,'{modelName}')"
     result = queryToCache(cacheKey, getChatContent, args=(messages, 3, modelName))
-    return result
\ No newline at end of file
+    return result
+
+
+#########################################
+#                                       #
+#      LONG DOCUMENT CHUNKING           #
+#                                       #
+#########################################
+
+defaultChunkTokens = 4000
+chunkWorkers = 4
+nullAnswers = {'', 'none', 'null', 'n/a', 'na', 'unknown', 'not found', 'not mentioned'}
+
+
+def countTokens(text, model=modelName):
+    """Counts tokens in text with the model's tokenizer, estimating if it is unavailable"""
+    try:
+        return token_counter(model=model, text=text)
+    except Exception:
+        return len(text) // 4
+
+
+def splitTextByTokens(text, model=modelName, maxTokens=None, withSeparators=False):
+    """Splits text into chunks of at most maxTokens, breaking on paragraphs, then sentences, then words
+
+    With withSeparators, returns (chunk, separator) pairs where separator is
+    the paragraph or sentence break that joins the chunk to the one before
+    it ('' for the first), so the chunks can be rejoined in the source layout."""
+    if maxTokens is None:
+        maxTokens = defaultChunkTokens
+
+    def pieces(block, level):
+        if level == 0:
+            return re.split(r'\n\s*\n', block)
+        if level == 1:
+            return re.split(r'(?<=[.!?])\s+', block)
+        return block.split(' ')
+
+    joiners = ['\n\n', ' ', ' ']
+    chunks = []
+    # Break the next chunk starts after, set to the level its boundary falls on
+    boundary = {'separator': ''}
+
+    def emit(current, level):
+        chunks.append((joiners[level].join(current), boundary['separator']))
+        boundary['separator'] = joiners[level]
+
+    def pack(block, level):
+        current = []
+        currentTokens = 0
+        for piece in pieces(block, level):
+            if not piece.strip():
+                continue
+            pieceTokens = countTokens(piece, model)
+            if pieceTokens > maxTokens and level < 2:
+                if current:
+                    emit(current, level)
+                    current, currentTokens = [], 0
+                pack(piece, level + 1)
+                boundary['separator'] = joiners[level]
+                continue
+            if current and currentTokens + pieceTokens > maxTokens:
+                emit(current, level)
+                current, currentTokens = [], 0
+            current.append(piece)
+            currentTokens += pieceTokens
+        if current:
+            emit(current, level)
+
+    pack(str(text), 0)
+    if withSeparators:
+        return chunks
+    return [chunk for chunk, separator in chunks]
+
+
+def isNullAnswer(answer):
+    return str(answer).strip().strip('."\'*').lower() in nullAnswers
+
+
+def reduceFirst(answers, **kwargs):
+    """First chunk answer that is not null-like"""
+    for answer in answers:
+        if not isNullAnswer(answer):
+            return answer
+    return answers[0] if answers else ''
+
+
+def reduceSum(answers, **kwargs):
+    """Sum of the first number found in each chunk answer"""
+    total = None
+    for answer in answers:
+        match = re.search(r'-?\d[\d,]*(?:\.\d+)?', str(answer))
+        if match:
+            total = (total or 0) + float(match.group(0).replace(',', ''))
+    if total is None:
+        return 'None'
+    return str(int(total)) if total == int(total) else str(total)
+
+
+def reduceUnion(answers, **kwargs):
+    """Order preserving union of comma, semicolon or line separated chunk answers"""
+    seen = set()
+    items = []
+    for answer in answers:
+        for item in re.split(r'[,;\n]', str(answer)):
+            item = item.strip().lstrip('-*• ').strip()
+            if isNullAnswer(item) or item.lower() in seen:
+                continue
+            seen.add(item.lower())
+            items.append(item)
+    return ', '.join(items) if items else 'None'
+
+
+def reduceLLM(answers, question='', persona='', model=modelName, tokens=2000, **kwargs):
+    """Asks the model to merge chunk answers into one final answer"""
+    partials = '\n'.join(f'* {answer}' for answer in answers)
+    mergePrompt = f"""The following are partial answers to the same question, each drawn from a different section of one long document.
+Combine them into a single final answer to the question, in the format the question requires. Output only the final answer.
+
+Question:
+{question}
+
+Partial answers:
+{partials}"""
+    return askChatQuestion(mergePrompt, persona, model=model, tokens=tokens)
+
+
+chunkReducers = {'first': reduceFirst,
+                 'sum': reduceSum,
+                 'union': reduceUnion,
+                 'llm': reduceLLM}
+
+
+def askChunkedQuestion(promptTemplate,
+                       chatVars,
+                       chunkVar,
+                       persona,
+                       model=modelName,
+                       tokens=2000,
+                       reduce='first',
+                       chunkTokens=None,
+                       extra_params=None,
+                       stop=None):
+    """Asks a node prompt over token sized chunks of one variable in parallel and reduces the answers"""
+    if not isValid(reduce) or reduce not in chunkReducers:
+        reduce = 'first'
+    if not isValid(chunkTokens):
+        chunkTokens = defaultChunkTokens
+    reducer = chunkReducers[reduce]
+
+    varStore = dict(chatVars)
+    chunks = splitTextByTokens(varStore[chunkVar], model, int(chunkTokens))
+    if len(chunks) <= 1:
+        return askChatQuestion(insertChatVars(promptTemplate, varStore),
+                               persona,
+                               model=model,
+                               tokens=tokens,
+                               extra_params=extra_params,
+                               stop=stop)
+
+    askChunk = lambda chunk: askChatQuestion(insertChatVars(promptTemplate, varStore | {chunkVar: chunk}),
+                                             persona,
+                                             model=model,
+                                             tokens=tokens,
+                                             extra_params=extra_params,
+                                             stop=stop)
+    with ThreadPoolExecutor(max_workers=chunkWorkers) as executor:
+        answers = list(executor.map(carryCallRecorders(askChunk), chunks))
+
+    question = insertChatVars(promptTemplate, varStore | {chunkVar: '(document omitted)'})
+    return reducer(answers, question=question, persona=persona, model=model, tokens=tokens)
+
+
+#########################################
+#                                       #
+#      PASSAGE RETRIEVAL                #
+#                                       #
+#########################################
+
+retrievalMinChars = 2000
+retrievalCacheSize = 64
+bm25K1 = 1.5
+bm25B = 0.75
+_retrievalIndexes = OrderedDict()
+_retrievalLock = threading.Lock()
+
+
+def tokenizeTerms(text):
+    return re.findall(r'\w+', str(text).lower())
+
+
+def splitSentences(text):
+    """Splits a document into sentence passages"""
+    sentences = re.split(r'(?<=[.!?])\s+|\n+', str(text))
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+
+def buildPassageIndex(text):
+    """Builds a BM25 index over the sentences of a document"""
+    passages = splitSentences(text)
+    termCounts = [Counter(tokenizeTerms(passage)) for passage in passages]
+    lengths = [sum(counts.values()) for counts in termCounts]
+    docFreq = Counter(term for counts in termCounts for term in counts)
+    numPassages = len(passages)
+    idf = {term: np.log(1 + (numPassages - freq + 0.5) / (freq + 0.5))
+           for term, freq in docFreq.items()}
+    return {'passages': passages,
+            'termCounts': termCounts,
+            'lengths': lengths,
+            'avgLength': (sum(lengths) / numPassages) if numPassages else 0,
+            'idf': idf}
+
+
+def getPassageIndex(text):
+    """Returns the BM25 index for a document, built once and kept in a small LRU"""
+    key = getHash(text)
+    with _retrievalLock:
+        if key in _retrievalIndexes:
+            _retrievalIndexes.move_to_end(key)
+            return _retrievalIndexes[key]
+
+    index = buildPassageIndex(text)
+    with _retrievalLock:
+        _retrievalIndexes[key] = index
+        while len(_retrievalIndexes) > retrievalCacheSize:
+            _retrievalIndexes.popitem(last=False)
+    return index
+
+
+def retrievePassages(text, query, k=5):
+    """Returns the top k BM25 passages of text for query, in document order"""
+    index = getPassageIndex(text)
+    queryTerms = [term for term in set(tokenizeTerms(query)) if term in index['idf']]
+    scores = []
+    for position, (counts, length) in enumerate(zip(index['termCounts'], index['lengths'])):
+        score = 0.0
+        norm = bm25K1 * (1 - bm25B + bm25B * length / (index['avgLength'] or 1))
+        for term in queryTerms:
+            freq = counts.get(term, 0)
+            if freq:
+                score += index['idf'][term] * freq * (bm25K1 + 1) / (freq + norm)
+        scores.append((score, position))
+
+    top = sorted(scores, key=lambda x: (-x[0], x[1]))[:k]
+    # Passages sharing no terms with the query only pad the prompt
+    top = [match for match in top if match[0] > 0] or top
+    return '\n'.join(index['passages'][position] for _, position in sorted(top, key=lambda x: x[1]))
+
+
+def parseRetrieve(spec):
+    """Parses a node retrieve value ('retrieve:k' or k) to a positive int, None if unset or invalid"""
+    if not isValid(spec) or str(spec).strip() == '':
+        return None
+    value = str(spec).strip()
+    if value.startswith('retrieve:'):
+        value = value[9:]
+    try:
+        k = float(value)
+    except (TypeError, ValueError, OverflowError):
+        k = None
+    if k is None or not k.is_integer() or k <= 0:
+        print(f"[Warning] Could not parse retrieve value: {spec!r}, retrieval disabled")
+        return None
+    return int(k)
+
+
+def retrievePassageVars(promptTemplate, chatVars, k):
+    """Returns a var store where long variables used by the prompt are cut to their top k passages.
+
+    The query is the prompt with the long variables themselves left out."""
+    varStore = dict(chatVars)
+    longVars = [var for var in extractChatVars(promptTemplate)
+                if var in varStore and len(str(varStore[var])) >= retrievalMinChars]
+    if not longVars:
+        return varStore
+
+    query = insertChatVars(promptTemplate, {var: value for var, value in varStore.items() if var not in longVars})
+    for var in longVars:
+        varStore[var] = retrievePassages(varStore[var], query, k)
+    return varStore
+
+
+#########################################
+#                                       #
+#      NEAR-DUPLICATE DETECTION         #
+#                                       #
+#########################################
+
+nearDupThreshold = 0.8
+shingleSize = 5
+minhashBands = 16
+minhashRows = 4
+minhashMinWords = 50
+_minhashPrime = np.uint64((1 << 31) - 1)
+_minhashRng = np.random.RandomState(20240601)
+_minhashA = _minhashRng.randint(1, (1 << 31) - 1, size=minhashBands * minhashRows).astype(np.uint64)
+_minhashB = _minhashRng.randint(0, (1 << 31) - 1, size=minhashBands * minhashRows).astype(np.uint64)
+
+
+def minhashSignature(text):
+    """MinHash signature of a text's word shingles, None if it is too short to compare"""
+    words = tokenizeTerms(text)
+    if len(words) < max(minhashMinWords, shingleSize):
+        return None
+    shingles = {' '.join(words[i:i + shingleSize]) for i in range(len(words) - shingleSize + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                         dtype=np.uint64,
+                         count=len(shingles))
+    # a < 2^31 and hashes < 2^32 so the products fit in uint64
+    return ((_minhashA[:, None] * hashes[None, :] + _minhashB[:, None]) % _minhashPrime).min(axis=1)
+
+
+def clusterNearDuplicates(texts, threshold=None):
+    """Groups near-identical texts, returning for each text the position of its cluster representative.
+
+    Candidate pairs come from LSH banding over MinHash signatures and are
+    kept when their estimated Jaccard similarity reaches threshold. The
+    longest text in each cluster is its representative. Texts too short to
+    compare, such as scrape errors, stay in their own clusters."""
+    if threshold is None:
+        threshold = nearDupThreshold
+    texts = ['' if not isValid(text) else str(text) for text in texts]
+    signatures = [minhashSignature(text) for text in texts]
+
+    parents = list(range(len(texts)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    buckets = dict()
+    for position, signature in enumerate(signatures):
+        if signature is None:
+            continue
+        for band in range(minhashBands):
+            key = (band, signature[band * minhashRows:(band + 1) * minhashRows].tobytes())
+            buckets.setdefault(key, []).append(position)
+
+    checked = set()
+    for members in buckets.values():
+        for other in members[1:]:
+            pair = (members[0], other)
+            if pair in checked:
+                continue
+            checked.add(pair)
+            similarity = float(np.mean(signatures[pair[0]] == signatures[other]))
+            if similarity >= threshold:
+                parents[find(other)] = find(pair[0])
+
+    clusters = dict()
+    for position in range(len(texts)):
+        clusters.setdefault(find(position), []).append(position)
+
+    representatives = [None] * len(texts)
+    for members in clusters.values():
+        representative = max(members, key=lambda position: (len(texts[position]), -position))
+        for position in members:
+            representatives[position] = representative
+    return representatives
+
+
+def markNearDuplicates(dfIn, column='scraped_text', threshold=None):
+    """Adds 'duplicate_of' (index label of the cluster representative) and 'is_representative' columns"""
+    df = dfIn.copy(deep=True)
+    representatives = clusterNearDuplicates(df[column].tolist(), threshold)
+    df['duplicate_of'] = [df.index[position] for position in representatives]
+    df['is_representative'] = [position == representative for position, representative in enumerate(representatives)]
+    return df
+
+
+def dropNearDuplicates(dfIn, column='scraped_text', threshold=None):
+    """Keeps one representative row per near-duplicate cluster"""
+    df = markNearDuplicates(dfIn, column, threshold)
+    return df[df['is_representative']]
+
+
+def fanOutResults(df, resultCols):
+    """Copies result columns from each cluster representative onto its duplicates, after markNearDuplicates"""
+    df = df.copy(deep=True)
+    duplicates = ~df['is_representative']
+    for col in resultCols:
+        df.loc[duplicates, col] = df.loc[df.loc[duplicates, 'duplicate_of'], col].values
+    return df
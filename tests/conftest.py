@@ -0,0 +1,45 @@
+import os
+import sys
+import tempfile
+import types
+
+import pandas as pd
+import pytest
+
+os.environ.setdefault('LITELLM_LOCAL_MODEL_COST_MAP', 'True')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'tabulairity'))
+
+# tabulairity creates its SQLite cache in the working directory on import
+os.chdir(tempfile.mkdtemp(prefix='tabulairity-tests-'))
+
+import tabulairity as tb
+
+
+def fakeResponse(content, promptTokens=11, completionTokens=2):
+    """Mimics the litellm completion response fields tabulairity reads"""
+    message = types.SimpleNamespace(content=content)
+    usage = types.SimpleNamespace(prompt_tokens=promptTokens,
+                                  completion_tokens=completionTokens,
+                                  total_tokens=promptTokens + completionTokens)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+
+@pytest.fixture
+def fakeModel(monkeypatch):
+    """Routes model 'fake' to a stub completion; set fakeModel.reply(prompt) to control answers"""
+    originalRoutes = tb.modelRoutes
+    tb.setModelRoutes(pd.DataFrame({'model': ['fake'], 'route': ['ollama/fake'], 'ip': ['http://localhost:1']}))
+    stub = types.SimpleNamespace(reply=lambda prompt: 'yes', calls=[])
+
+    def completion(**kwargs):
+        stub.calls.append(kwargs)
+        answer = stub.reply(kwargs['messages'][-1]['content'])
+        if kwargs.get('stream'):
+            delta = types.SimpleNamespace(content=answer)
+            return iter([types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])])
+        return fakeResponse(answer)
+
+    monkeypatch.setattr(tb, 'completion', completion)
+    monkeypatch.setattr(tb, 'modelName', 'fake')
+    yield stub
+    tb.setModelRoutes(originalRoutes)
@@ -0,0 +1,42 @@
+import uuid
+
+import pytest
+
+import tabulairity as tb
+
+
+def uniquePrompt(text):
+    return f'{text} {uuid.uuid4().hex}'
+
+
+def test_records_every_uncached_call(fakeModel):
+    with tb.recordCalls() as calls:
+        tb.askChatQuestion(uniquePrompt('first'), 'persona', model='fake')
+        tb.askChatQuestion(uniquePrompt('second'), 'persona', model='fake')
+    assert len(calls) == 2
+    assert not any(call['cached'] for call in calls)
+    assert tb.summarizeCalls(calls)['prompt_tokens'] == 22
+
+
+def test_nested_recorders_unwind_by_identity(fakeModel):
+    with tb.recordCalls() as outer:
+        with tb.recordCalls() as inner:
+            tb.askChatQuestion(uniquePrompt('inner'), 'persona', model='fake')
+        assert inner == outer
+        tb.askChatQuestion(uniquePrompt('outer'), 'persona', model='fake')
+        assert len(inner) == 1
+    assert len(outer) == 2
+    assert not tb.isRecordingCalls()
+
+
+def test_cache_hits_report_stored_metadata(fakeModel):
+    prompt = uniquePrompt('cached')
+    with tb.recordCalls() as first:
+        tb.askChatQuestion(prompt, 'persona', model='fake')
+    with tb.recordCalls() as second:
+        tb.askChatQuestion(prompt, 'persona', model='fake')
+    with tb.recordCalls(bypassCache=True) as bypassed:
+        tb.askChatQuestion(prompt, 'persona', model='fake')
+    assert second[0]['cached'] and second[0]['latency'] == pytest.approx(first[0]['latency'])
+    assert not bypassed[0]['cached']
+    assert len(fakeModel.calls) == 2
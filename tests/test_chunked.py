@@ -0,0 +1,50 @@
+import pandas as pd
+
+import tabulairity as tb
+
+
+def buildNet(rows):
+    script = pd.DataFrame([dict({'type': 'node', 'prompt': 'Summarize: [doc]', 'persona': 'persona',
+                                 'tokens': 50, 'fx': None, 'self_eval': False, 'model': 'fake',
+                                 'chunk': 'doc'}, **row) for row in rows])
+    return tb.buildChatNet(script)
+
+
+def test_invalid_reduce_and_chunk_tokens_fall_back(capsys):
+    G = buildNet([{'key': 'Bad', 'reduce': 'average', 'chunk_tokens': 'lots'},
+                  {'key': 'Negative', 'reduce': ' sum ', 'chunk_tokens': -5},
+                  {'key': 'Good', 'reduce': 'union', 'chunk_tokens': 300.0},
+                  {'key': 'Blank', 'reduce': None, 'chunk_tokens': None}])
+    nodes = dict(G.nodes(data=True))
+    assert (nodes['Bad']['reduce'], nodes['Bad']['chunk_tokens']) == ('first', None)
+    assert (nodes['Negative']['reduce'], nodes['Negative']['chunk_tokens']) == ('sum', None)
+    assert (nodes['Good']['reduce'], nodes['Good']['chunk_tokens']) == ('union', 300)
+    assert not tb.isValid(nodes['Blank']['reduce']) and not tb.isValid(nodes['Blank']['chunk_tokens'])
+
+    printed = capsys.readouterr().out
+    assert "Could not parse reduce value: 'average'" in printed
+    assert "Could not parse chunk_tokens value: 'lots'" in printed
+    assert "Could not parse chunk_tokens value: -5" in printed
+
+
+def test_unknown_reduce_does_not_raise(fakeModel):
+    fakeModel.reply = lambda prompt: 'partial answer'
+    answer = tb.askChunkedQuestion('Summarize unknown reduce: [doc]', {'doc': 'word ' * 200}, 'doc',
+                                   'persona', model='fake', reduce='average', chunkTokens=20)
+    assert answer == 'partial answer'
+
+
+def test_retrieve_is_parsed_once_at_build_time(capsys):
+    G = buildNet([{'key': 'Spec', 'retrieve': 'retrieve:3'},
+                  {'key': 'Plain', 'retrieve': 2.0},
+                  {'key': 'Infinite', 'retrieve': 'retrieve:inf'},
+                  {'key': 'Zero', 'retrieve': 0},
+                  {'key': 'Junk', 'retrieve': 'lots'},
+                  {'key': 'Blank', 'retrieve': None}])
+    nodes = dict(G.nodes(data=True))
+    assert nodes['Spec']['retrieve'] == 3 and nodes['Plain']['retrieve'] == 2
+    assert not any(tb.isValid(nodes[key]['retrieve']) for key in ['Infinite', 'Zero', 'Junk', 'Blank'])
+
+    printed = capsys.readouterr().out
+    for value in ["'retrieve:inf'", '0', "'lots'"]:
+        assert f"Could not parse retrieve value: {value}" in printed
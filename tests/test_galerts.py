@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+
+import gsheetconnector as gs
+import tabulairity as tb
+
+viableText = 'The city council approved the new budget after a long public debate. ' * 5
+pages = {'https://news.example/budget': viableText,
+         'https://news.example/broken': 'Error: 404 not found'}
+
+
+@pytest.fixture
+def fakeAlerts(fakeModel, monkeypatch):
+    feedDf = pd.DataFrame({'title': ['City council approves the new budget', 'Regional election results announced'],
+                           'published': ['2026-10-01', '2026-10-01'],
+                           'updated': ['2026-10-01', '2026-10-01'],
+                           'summary': ['The council voted on the budget today', 'Officials counted the final ballots'],
+                           'url': list(pages)})
+    monkeypatch.setattr(gs, 'fetchFeeds', lambda feedURLs: [feedDf.copy() for _ in feedURLs])
+    monkeypatch.setattr(tb, 'cachePages', lambda urls: [pages[url] for url in urls])
+    return pd.DataFrame({'rss feed': ['https://alerts.example/feed'], 'topic': ['budget']})
+
+
+def test_only_viable_pages_are_marked_seen(fakeAlerts):
+    first = gs.getGAlerts(fakeAlerts, incremental=True)
+    assert set(first['url']) == set(pages)
+    assert gs.filterSeen(list(pages), gs.seenUrlKey) == [True, False]
+
+    second = gs.getGAlerts(fakeAlerts, incremental=True)
+    assert second['url'].tolist() == ['https://news.example/broken']
+
+
+def test_empty_delta_keeps_columns(fakeAlerts, monkeypatch):
+    first = gs.getGAlerts(fakeAlerts, incremental=True)
+    monkeypatch.setattr(gs, 'filterSeen', lambda values, keyFn: [True] * len(values))
+    empty = gs.getGAlerts(fakeAlerts, incremental=True)
+    assert empty.empty
+    assert {'title_translated', 'scraped_text', 'viable_page'} <= set(empty.columns)
+    assert set(empty.columns) == set(first.columns)
+
+
+def test_empty_poll_keeps_columns(fakeAlerts, monkeypatch):
+    first = gs.getGAlerts(fakeAlerts, incremental=True)
+    monkeypatch.setattr(gs, 'fetchFeeds', lambda feedURLs: [pd.DataFrame(columns=gs.feedCols) for _ in feedURLs])
+    empty = gs.getGAlerts(fakeAlerts, incremental=True)
+    assert empty.empty
+    assert set(empty.columns) == set(first.columns)
@@ -0,0 +1,32 @@
+import os
+import warnings
+
+import pytest
+
+import scrapertools as st
+
+corpusDir = os.path.join(os.path.dirname(__file__), 'data', 'html')
+pages = sorted(fileName[:-5] for fileName in os.listdir(corpusDir) if fileName.endswith('.html'))
+
+
+def readCorpus(name, extension):
+    with open(os.path.join(corpusDir, name + extension), encoding='utf-8') as corpusFile:
+        return corpusFile.read()
+
+
+@pytest.mark.parametrize('backend', list(st.parserBackends))
+@pytest.mark.parametrize('page', pages)
+def test_backend_matches_golden_text(page, backend):
+    if st.resolveParserBackend(backend) != backend:
+        pytest.skip(f"{backend} is not installed")
+    with warnings.catch_warnings():
+        # malformed.html carries an XML declaration, which bs4 warns about
+        warnings.simplefilter('ignore')
+        assert st.extractText(readCorpus(page, '.html'), backend=backend) == readCorpus(page, '.txt').strip()
+
+
+def test_benchmark_reports_identical_backends():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results = st.benchmarkParsers(corpusDir, repeats=1)
+    assert all(result['identical'] == len(pages) for result in results.values())
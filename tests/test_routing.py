@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import tabulairity as tb
+
+
+@pytest.fixture
+def singleRoute():
+    originalRoutes = tb.modelRoutes
+    tb.setModelRoutes(pd.DataFrame({'model': ['solo'], 'route': ['ollama/solo'], 'ip': ['http://localhost:1']}))
+    state = tb.routeTable['solo'][0]
+    state['circuit'] = 'open'
+    state['openedAt'] = time.monotonic() - tb.circuitCooldown - 1
+    yield state
+    tb.setModelRoutes(originalRoutes)
+
+
+def acquireInThread(outcome):
+    def run():
+        try:
+            outcome['state'] = tb.acquireRoute('solo')
+        except ConnectionError as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_callers_wait_for_half_open_trial_success(singleRoute):
+    trial = tb.acquireRoute('solo')
+    assert trial['circuit'] == 'half-open'
+
+    outcome = {}
+    waiter = acquireInThread(outcome)
+    waiter.join(timeout=0.3)
+    assert waiter.is_alive()
+
+    tb.releaseRoute(trial, 0.1, success=True)
+    waiter.join(timeout=5)
+    assert outcome.get('state') is singleRoute
+    assert singleRoute['circuit'] == 'closed'
+    tb.releaseRoute(outcome['state'], 0.1)
+
+
+def test_callers_fail_once_half_open_trial_fails(singleRoute):
+    trial = tb.acquireRoute('solo')
+    outcome = {}
+    waiter = acquireInThread(outcome)
+    waiter.join(timeout=0.3)
+    assert waiter.is_alive()
+
+    tb.releaseRoute(trial, 0.1, success=False, error=ConnectionError('down'))
+    waiter.join(timeout=5)
+    assert isinstance(outcome.get('error'), ConnectionError)
+
+
+def test_trial_wait_is_bounded(singleRoute, monkeypatch):
+    monkeypatch.setattr(tb, 'circuitTrialWait', 0.2)
+    tb.acquireRoute('solo')
+    with pytest.raises(ConnectionError):
+        tb.acquireRoute('solo')
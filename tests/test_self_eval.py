@@ -0,0 +1,39 @@
+import uuid
+
+import pytest
+
+import tabulairity as tb
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('Yes, it does.', 'yes'),
+    ('"No."', 'no'),
+    (True, 'yes'),
+    (False, 'no'),
+    ('true', 'yes'),
+    ('The answer provides a usable count, although it does not give the date.', None),
+    ('There is nothing in the answer identifying the author as an AI.', None),
+    ('Nothing identifies the author as an AI.', None),
+    ('Maybe', None),
+    ('', None),
+])
+def test_local_yn_only_classifies_unambiguous_answers(text, expected):
+    assert tb.localYN(text) == expected
+
+
+def test_ambiguous_answers_fall_back_to_get_yn(fakeModel, monkeypatch):
+    monkeypatch.setattr(tb, 'fusedSelfEval', False)
+    def reply(prompt):
+        if 'standardizes' in prompt or 'coding the ouput' in prompt:
+            return 'no' if 'nothing in the answer' in prompt else 'yes'
+        if 'identifying itself as an AI' in prompt:
+            return 'There is nothing in the answer identifying the author as an AI.'
+        return 'The answer provides a usable count, although it does not give the date.'
+    fakeModel.reply = reply
+    assert tb.isUseful(f'How many? {uuid.uuid4().hex}', 'Seven.')
+
+
+def test_fused_eval_reads_json_booleans(fakeModel):
+    fakeModel.reply = lambda prompt: '{"answers_question": true, "identifies_as_ai": true}'
+    assert not tb.isUseful(f'How many? {uuid.uuid4().hex}', 'As an AI, seven.')
+    assert len(fakeModel.calls) == 1
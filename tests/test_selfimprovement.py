@@ -0,0 +1,102 @@
+from random import Random
+
+import pandas as pd
+import pytest
+
+import selfimprovement as si
+import tabulairity as tb
+
+
+def fixedAccuracy(accuracy):
+    """Stands in for evaluateAnswer with a deterministic per-row outcome at the given accuracy"""
+    def evaluate(prompt, persona, row, model, evaluatorNet, bypassCache=False):
+        correct = Random(int(row['x'])).random() < accuracy
+        return correct, None if correct else 'wrong', 0.1, 10
+    return evaluate
+
+
+@pytest.fixture
+def testDf():
+    return pd.DataFrame({'x': range(200)})
+
+
+def test_full_evaluation_keeps_row_order(monkeypatch, testDf):
+    monkeypatch.setattr(si, 'evaluateAnswer', fixedAccuracy(0.6))
+    scores, errors, times, tokens = si.evaluateTestSet('p', 'q', testDf, 'm', None, numWorkers=8)
+    expected = [Random(x).random() < 0.6 for x in range(200)]
+    assert scores == expected
+    assert len(errors) == expected.count(False)
+
+
+def test_adaptive_rejects_weak_candidates_early(monkeypatch, testDf):
+    monkeypatch.setattr(si, 'evaluateAnswer', fixedAccuracy(0.2))
+    scores, _, _, _ = si.evaluateTestSet('p', 'q', testDf, 'm', None, incumbent=0.6, seed=1)
+    assert si.adaptiveMinRows <= len(scores) < len(testDf)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_adaptive_scores_promising_candidates_on_every_row(monkeypatch, testDf, seed):
+    monkeypatch.setattr(si, 'evaluateAnswer', fixedAccuracy(0.6))
+    scores, _, _, _ = si.evaluateTestSet('p', 'q', testDf, 'm', None, incumbent=0.5, seed=seed)
+    assert len(scores) == len(testDf)
+
+
+def test_weighted_objective_disables_adaptive_stopping(monkeypatch, testDf):
+    seen = []
+    def evaluateTestSet(prompt, persona, testDf, model, evaluatorNet, numWorkers=None,
+                        incumbent=None, seed=None, bypassCache=False):
+        seen.append(incumbent)
+        return [True] * 20 + [False] * 20, ['wrong'] * 20, [1.0] * 40, [10] * 40
+    monkeypatch.setattr(si, 'evaluateTestSet', evaluateTestSet)
+    monkeypatch.setattr(si, 'getEvaluatorNet', lambda supervisor: None)
+    monkeypatch.setattr(si, 'summarizeErrors', lambda errors, intent, model: 'summary')
+    monkeypatch.setattr(si, 'rewritePrompt', lambda prompt, persona, model, **kwargs: (prompt + '!', persona))
+    si.iteratePrompt('p', 'q', testDf, 'm', depth=2, intent='i', adaptive=True, latencyWeight=0.01)
+    assert seen == [None, None, None]
+
+
+def stubBeamSearch(monkeypatch, accuracyOf):
+    """Stubs the LLM steps of beamSearchPrompt; each rewrite and test row records one uncached call"""
+    def recordedCall():
+        tb.recordCall(model='m', route='m', cached=False, latency=0.0, wait=0.0,
+                      prompt_tokens=1, completion_tokens=1)
+
+    def rewritePrompt(prompt, persona, model, seed=None, **kwargs):
+        recordedCall()
+        return f'{prompt}+{seed}', persona
+
+    def evaluateAnswer(prompt, persona, row, model, evaluatorNet, bypassCache=False):
+        recordedCall()
+        correct = Random(hash((prompt, int(row['x'])))).random() < accuracyOf(prompt)
+        return correct, None if correct else 'wrong', 0.1, 10
+
+    monkeypatch.setattr(si, 'getEvaluatorNet', lambda supervisor: None)
+    monkeypatch.setattr(si, 'summarizeErrors', lambda errors, intent, model: 'summary')
+    monkeypatch.setattr(si, 'rewritePrompt', rewritePrompt)
+    monkeypatch.setattr(si, 'evaluateAnswer', evaluateAnswer)
+
+
+def test_beam_only_ranks_fully_scored_candidates(monkeypatch, testDf):
+    stubBeamSearch(monkeypatch, lambda prompt: 0.95 if prompt.count('+') == 1 else 0.5)
+    history = si.beamSearchPrompt('p', 'q', testDf, 'm', rounds=2, beamWidth=2, branching=3,
+                                  intent='i', seed=3, adaptive=True)
+    assert (history.loc[history.iteration <= 1, 'rows_evaluated'] == len(testDf)).all()
+    assert (history.rows_evaluated < len(testDf)).any()
+    assert history.iteration.max() == 2
+
+
+def test_beam_budget_caps_this_search_calls(monkeypatch, testDf):
+    stubBeamSearch(monkeypatch, lambda prompt: 0.5)
+    budget = len(testDf) + 50
+    with tb.recordCalls() as searchCalls:
+        si.beamSearchPrompt('p', 'q', testDf, 'm', rounds=5, beamWidth=2, branching=3,
+                            intent='i', seed=3, budget=budget)
+    # Rows already in flight may finish after the cap is hit, but no more than one batch per worker
+    assert budget <= len(searchCalls) <= budget + si.evalWorkers * 3 * 2
+
+
+def test_weighted_objective_disables_adaptive_in_beam(monkeypatch, testDf):
+    stubBeamSearch(monkeypatch, lambda prompt: 0.95 if prompt.count('+') == 1 else 0.5)
+    history = si.beamSearchPrompt('p', 'q', testDf, 'm', rounds=2, beamWidth=2, branching=3,
+                                  intent='i', seed=3, adaptive=True, latencyWeight=0.01)
+    assert (history.rows_evaluated == len(testDf)).all()
@@ -0,0 +1,60 @@
+import json
+import uuid
+
+import pandas as pd
+import pytest
+
+import tabulairity as tb
+
+
+def buildNet(tag):
+    nodeRow = lambda key, prompt, **extra: dict({'key': key, 'type': 'node', 'prompt': prompt,
+                                                 'persona': 'persona', 'tokens': 50, 'fx': None,
+                                                 'self_eval': False, 'model': 'fake'}, **extra)
+    edgeRow = lambda key: {'key': key, 'type': 'edge', 'prompt': '', 'fx': None}
+    script = pd.DataFrame([nodeRow('Start', f'Is this useful {tag}?', self_eval=True),
+                           nodeRow('Summary', f'Summarize {tag}: [doc]', chunk='doc', reduce='llm', chunk_tokens=20),
+                           edgeRow('Start-Summary')])
+    return tb.buildChatNet(script)
+
+
+@pytest.fixture
+def tracing(tmp_path):
+    exportPath = tmp_path / 'spans.jsonl'
+    tb.clearTraces()
+    tb.enableTracing(str(exportPath), docVar='doc_id')
+    yield exportPath
+    tb.disableTracing()
+    tb.clearTraces()
+
+
+def fusedAwareReply(prompt):
+    if 'answers_question' in prompt:
+        return '{"answers_question": true, "identifies_as_ai": false}'
+    return 'yes'
+
+
+@pytest.mark.parametrize('runAsync', [False, True])
+def test_traced_walk_over_self_eval_and_chunked_nodes(fakeModel, tracing, runAsync):
+    fakeModel.reply = fusedAwareReply
+    tag = uuid.uuid4().hex
+    doc = '\n\n'.join(f'Paragraph {i} of the document has several words in it.' for i in range(6))
+    varStore = {'doc': doc, 'doc_id': 'doc-1'}
+
+    traced = tb.walkChatNet(buildNet(tag), varStore=varStore, verbosity=0, runAsync=runAsync)
+    uncalled = len(fakeModel.calls)
+    tb.disableTracing()
+    untraced = tb.walkChatNet(buildNet(tag), varStore=varStore, verbosity=0, runAsync=runAsync)
+
+    assert traced['Summary_raw'] == untraced['Summary_raw'] == 'yes'
+    spans = tb.getTraceSpans().set_index('node')
+    assert spans.loc['Start', 'calls'] == 2
+    chunkCalls = uncalled - 2
+    assert chunkCalls > 2
+    assert spans.loc['Summary', 'calls'] == chunkCalls
+    assert (spans.status == 'ok').all()
+    assert set(spans.doc_id) == {'doc-1'}
+
+    exported = [json.loads(line) for line in tracing.read_text().splitlines()]
+    assert [span['node'] for span in exported] == ['Start', 'Summary']
+    assert tb.criticalPath(pd.DataFrame(exported)).path[0] == ['Start', 'Summary']
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import tabulairity as tb
+
+
+@pytest.fixture
+def fakeTranslator(fakeModel, monkeypatch):
+    monkeypatch.setattr(tb, 'translationModel', 'fake')
+    dictionary = {'hola': 'hello', 'adios': 'goodbye', 'gato': 'cat', 'perro': 'dog'}
+
+    def reply(prompt):
+        body = prompt.split('\n\n', 1)[1]
+        if body.startswith('['):
+            return json.dumps([dictionary[text] for text in json.loads(body)])
+        return dictionary[body]
+
+    fakeModel.reply = reply
+    return fakeModel
+
+
+def test_batched_translations_fill_single_text_cache(fakeTranslator):
+    assert tb.translateMany(['hola', 'adios']) == {'hola': 'hello', 'adios': 'goodbye'}
+    assert len(fakeTranslator.calls) == 1
+
+    assert tb.translateOne('hola') == 'hello'
+    assert len(fakeTranslator.calls) == 1
+
+
+def test_cached_texts_are_not_packed_into_batches(fakeTranslator):
+    assert tb.translateOne('gato') == 'cat'
+    fakeTranslator.calls.clear()
+
+    with tb.recordCalls() as calls:
+        assert tb.translateMany(['gato', 'perro']) == {'gato': 'cat', 'perro': 'dog'}
+    assert len(fakeTranslator.calls) == 1
+    assert 'gato' not in fakeTranslator.calls[0]['messages'][-1]['content']
+    assert sorted(bool(call.get('cached')) for call in calls) == [False, True]
+
+
+def test_long_paragraphs_keep_their_layout(fakeModel, monkeypatch):
+    monkeypatch.setattr(tb, 'translationModel', 'fake')
+    monkeypatch.setattr(tb, 'translateChunkTokens', 12)
+    fakeModel.reply = lambda prompt: prompt.split('\n\n', 1)[1].upper()
+    text = ('The first sentence of the long paragraph runs on for a while. '
+            'The second sentence of the long paragraph also runs on. '
+            'The third sentence closes the long paragraph here.'
+            '\n\nA short closing paragraph.')
+
+    chunks = tb.splitTextByTokens(text, 'fake', 12, withSeparators=True)
+    separators = [separator for chunk, separator in chunks]
+    assert separators[0] == '' and separators[-1] == '\n\n'
+    assert len(chunks) > 2 and set(separators[1:-1]) == {' '}
+    assert tb.translateOne(text) == text.upper()